@@ -0,0 +1,144 @@
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from elasticsearch import (
+    ConnectionError,
+    ConnectionTimeout,
+    Elasticsearch,
+    Transport
+)
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+lock = threading.Lock()
+client = None
+client_pid = None
+
+
+class HealthTracker(object):
+    '''
+    Tracks whether elasticsearch can be reached from the outcome of the
+    requests sent anyway. Once a request couldn't connect, the circuit
+    is open: requests should fail fast while a background thread pings
+    the cluster every probe_interval seconds until it answers again.
+    Timeouts don't open it, a slow query doesn't mean the cluster is down.
+    '''
+    def __init__(self, probe_interval=5):
+        self.probe_interval = probe_interval
+        self.healthy = True
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def available(self):
+        if not self.healthy:
+            # A forked process inherits the state but not the thread
+            self.start_probe()
+        return self.healthy
+
+    def success(self):
+        if not self.healthy:
+            logger.info('Elasticsearch is reachable again')
+        self.healthy = True
+
+    def failure(self):
+        if self.healthy:
+            logger.warn('Could not connect to Elasticsearch, '
+                        'failing searches until it is reachable')
+        self.healthy = False
+        self.start_probe()
+
+    def start_probe(self):
+        with self.lock:
+            if (self.pid == os.getpid() and self.thread is not None and
+                    self.thread.is_alive()):
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(
+                target=self.probe,
+                name='elasticsearch-health-probe'
+            )
+            self.thread.daemon = True
+            self.thread.start()
+
+    def probe(self):
+        while not self.healthy:
+            time.sleep(self.probe_interval)
+            # The transport records the outcome
+            get_client().ping()
+
+
+health = HealthTracker(
+    probe_interval=getattr(settings, 'ES_HEALTH_PROBE_INTERVAL', 5)
+)
+
+
+class HealthTrackingTransport(Transport):
+    '''
+    Records the outcome of every request in the health tracker
+    '''
+    def perform_request(self, *args, **kwargs):
+        try:
+            response = super(HealthTrackingTransport, self).perform_request(
+                *args, **kwargs
+            )
+        except ConnectionTimeout:
+            raise
+        except ConnectionError:
+            health.failure()
+            raise
+        health.success()
+        return response
+
+
+def client_options():
+    '''
+    Builds the options of the elasticsearch client from settings.
+
+    Settings:
+    ES_HOSTS: List of hosts, defaults to [ES_URL]
+    ES_MAXSIZE: Open connections kept alive per host, default 10
+    ES_TIMEOUT: Seconds to wait for a response, default 10
+    ES_HTTP_COMPRESS: Gzip request bodies, default False
+    ES_CLIENT_OPTIONS: Any other options of the Elasticsearch client
+    '''
+    options = {
+        'hosts': getattr(settings, 'ES_HOSTS', None) or [settings.ES_URL],
+        'maxsize': getattr(settings, 'ES_MAXSIZE', 10),
+        'timeout': getattr(settings, 'ES_TIMEOUT', 10),
+        'retry_on_timeout': True,
+        'transport_class': HealthTrackingTransport
+    }
+    # Only passed when set, older clients don't support it
+    if getattr(settings, 'ES_HTTP_COMPRESS', False):
+        options['http_compress'] = True
+    options.update(getattr(settings, 'ES_CLIENT_OPTIONS', {}))
+    return options
+
+
+def get_client():
+    '''
+    Gets the elasticsearch client of this process. Its connections are
+    reused between requests. A forked process, such as a gunicorn
+    worker, creates its own client instead of sharing the parent's sockets.
+    '''
+    global client, client_pid
+    if client is None or client_pid != os.getpid():
+        with lock:
+            if client is None or client_pid != os.getpid():
+                client = Elasticsearch(**client_options())
+                client_pid = os.getpid()
+    return client
+
+
+class LazyClient(object):
+    '''
+    Stands in for the client of the current process,
+    for use as the elasticsearch_dsl default connection
+    '''
+    def __getattr__(self, name):
+        return getattr(get_client(), name)
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+lock = threading.Lock()
+
+
+def get_path():
+    '''
+    Gets the JSON lines file documents that failed to index are written to,
+    settings.ES_DEAD_LETTER_PATH or elasticsearch_dead_letters.jsonl
+    in the project root.
+    '''
+    path = getattr(settings, 'ES_DEAD_LETTER_PATH', None)
+    if path is None:
+        root = getattr(settings, 'PROJECT_ROOT', os.getcwd())
+        path = os.path.join(root, 'elasticsearch_dead_letters.jsonl')
+    return path
+
+
+def record(index, id, error, op_type='index'):
+    '''
+    Records a document that failed to index, to be retried
+    with the retry_dead_letters command.
+    :param index: The name of the index the document was sent to
+    :param id: The id of the document
+    :param error: The reason elasticsearch gave
+    :param op_type: The bulk operation, index or delete
+    '''
+    record_many([{
+        'index': index,
+        'id': id,
+        'op_type': op_type,
+        'error': error
+    }])
+
+
+def record_bulk_errors(errors):
+    '''
+    Records the failed documents of bulk error items
+    '''
+    entries = []
+    for error in errors:
+        op_type, info = list(error.items())[0]
+        # Deleting a document that was never indexed is fine
+        if op_type == 'delete' and info.get('status') == 404:
+            continue
+        entries.append({
+            'index': info.get('_index'),
+            'id': info.get('_id'),
+            'op_type': op_type,
+            'error': info.get('error')
+        })
+    record_many(entries)
+
+
+def record_many(entries):
+    if not entries:
+        return
+    failed = timezone.now().isoformat()
+    lines = []
+    for entry in entries:
+        entry = dict(entry, failed=failed)
+        lines.append(json.dumps(entry, default=str, sort_keys=True) + '\n')
+    try:
+        with lock:
+            # Appends are written whole, so processes can share the file
+            with open(get_path(), 'a') as f:
+                f.write(''.join(lines))
+    except (IOError, OSError):
+        logger.exception('Error recording {0} failed documents'.format(
+            len(entries)
+        ))
+
+
+def read(path=None):
+    '''
+    Reads the recorded documents, oldest first
+    :return: A list of dicts with the index, id, op_type, error
+        and failed time of every failed document
+    '''
+    path = path or get_path()
+    if not os.path.exists(path):
+        return []
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return entries
+
+
+def taken_path():
+    return get_path() + '.retrying'
+
+
+def take():
+    '''
+    Moves the recorded documents aside to be retried. Documents that
+    fail meanwhile are recorded in a new file. Call forget once they
+    were retried, an interrupted retry takes them again.
+    :return: The list of entries, see read
+    '''
+    path = get_path()
+    with lock:
+        if os.path.exists(path):
+            if os.path.exists(taken_path()):
+                with open(taken_path(), 'a') as taken, open(path) as f:
+                    taken.write(f.read())
+                os.remove(path)
+            else:
+                os.rename(path, taken_path())
+    return read(taken_path())
+
+
+def forget():
+    '''
+    Removes the documents moved aside by take
+    '''
+    if os.path.exists(taken_path()):
+        os.remove(taken_path())
@@ -0,0 +1,103 @@
+# encoding: utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from elasticsearch_app.client import get_client
+from elasticsearch_app.utils import (
+    INDEXED_MODELS,
+    index_actions,
+    merge_sorted,
+    scan_index_hashes,
+    send_bulk
+)
+
+# Ids listed in the output per index and kind of drift
+REPORTED_IDS = 10
+
+MISSING = 'missing'
+ORPHANED = 'orphaned'
+STALE = 'stale'
+
+
+def find_drift(es, model, doctype):
+    '''
+    Compares the documents of an index with the documents built from
+    the database, both streamed in ascending order of id.
+    :param es: The elasticsearch client
+    :param model: The Django/GeoNode model
+    :param doctype: The doctype corresponding to the index
+    :return: A generator of (kind, id, action) triples, where action
+        is the bulk action that repairs the document
+    '''
+    index = doctype._doc_type.index
+    built = ((int(action['_id']), action)
+             for action in index_actions(model.objects.all(), doctype))
+    # Documents indexed without a hash are stale, not missing
+    indexed = ((id, content_hash or '')
+               for id, content_hash in scan_index_hashes(es, index))
+    for id, action, content_hash in merge_sorted(built, indexed):
+        if action is None:
+            yield ORPHANED, id, {
+                '_op_type': 'delete',
+                '_index': index,
+                '_type': doctype._doc_type.name,
+                '_id': id
+            }
+        elif content_hash is None:
+            yield MISSING, id, action
+        elif content_hash != action['_source'].get('content_hash'):
+            yield STALE, id, action
+
+
+class Command(BaseCommand):
+    help = "Reports documents that are missing, orphaned or stale in the indices."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            default=False,
+            help='Index the missing and stale documents and '
+                 'delete the orphaned ones.'
+        )
+
+    def handle(self, **options):
+        '''
+        Streams the id and content hash of every document from the
+        indices and the database at once, so memory use doesn't grow
+        with the size of the indices.
+        '''
+        es = get_client()
+        for model, doctype in INDEXED_MODELS:
+            counts = {MISSING: 0, ORPHANED: 0, STALE: 0}
+            ids = {MISSING: [], ORPHANED: [], STALE: []}
+
+            def drift():
+                for kind, id, action in find_drift(es, model, doctype):
+                    counts[kind] += 1
+                    if len(ids[kind]) < REPORTED_IDS:
+                        ids[kind].append(id)
+                    yield action
+
+            if options.get('fix'):
+                fixed, errors = send_bulk(es, drift())
+            else:
+                for action in drift():
+                    pass
+
+            index = doctype._doc_type.index
+            self.stdout.write("{0}: {1} missing, {2} orphaned, {3} stale".format(
+                index, counts[MISSING], counts[ORPHANED], counts[STALE]
+            ))
+            for kind in (MISSING, ORPHANED, STALE):
+                if ids[kind]:
+                    more = ', ...' if counts[kind] > len(ids[kind]) else ''
+                    self.stdout.write("  {0}: {1}{2}".format(
+                        kind, ', '.join(str(id) for id in ids[kind]), more
+                    ))
+            if options.get('fix'):
+                self.stdout.write("{0}: {1} fixed, {2} failed".format(
+                    index, fixed, len(errors)
+                ))
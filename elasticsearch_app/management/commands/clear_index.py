@@ -8,8 +8,10 @@ from __future__ import (
 )
 
 from django.core.management.base import BaseCommand
-from django.conf import settings
-from elasticsearch import Elasticsearch, TransportError
+from elasticsearch import TransportError
+
+from elasticsearch_app.client import get_client
+from elasticsearch_app.utils import invalidate_searchable_indices
 
 
 class Command(BaseCommand):
@@ -20,7 +22,7 @@ class Command(BaseCommand):
         Clears the search index of all elasticsearchapp indices
         '''
         self.stdout.write("Removing all documents indexed by elasticsearchapp")
-        es = Elasticsearch(settings.ES_URL)
+        es = get_client()
 
         # Delete all the indices this application creates
         # Any index added in search/signals should be added here
@@ -29,10 +31,22 @@ class Command(BaseCommand):
             'map-index',
             'document-index',
             'group-index',
-            'profile-index'
+            'profile-index',
+            'index-state',
+            'permission-index'
         ]
         for index in indices:
+            # An index name can be an alias of versioned
+            # indices from rebuild_index, delete those too
             try:
-                es.indices.delete(index=index)
+                names = es.indices.get(
+                    index='{0},{0}-*'.format(index),
+                    ignore_unavailable=True
+                ).keys()
             except TransportError:
+                names = []
+            if not names:
                 self.stdout.write("ERROR: Could not find index to delete: {}".format(index))
+                continue
+            es.indices.delete(index=','.join(names))
+        invalidate_searchable_indices()
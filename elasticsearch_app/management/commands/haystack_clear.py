@@ -3,8 +3,9 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from django.core.management.base import BaseCommand
-from django.conf import settings
-from elasticsearch import Elasticsearch, TransportError
+from elasticsearch import TransportError
+
+from elasticsearch_app.client import get_client
 
 
 class Command(BaseCommand):
@@ -15,7 +16,7 @@ class Command(BaseCommand):
         Clears out haystack's modelresult index from elasticsearch
         '''
         self.stdout.write("Removing modelresult index from elasticsearch")
-        es = Elasticsearch(settings.ES_URL)
+        es = get_client()
 
         try:
             es.indices.delete(index='modelresult')
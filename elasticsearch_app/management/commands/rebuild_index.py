@@ -2,13 +2,156 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from datetime import datetime
+
 from django.core.management import call_command
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from elasticsearch_app.client import get_client
+from elasticsearch_app.management.commands.update_index import (
+    get_modified_field,
+    get_queryset,
+    index_pk_range
+)
+from elasticsearch_app.search import get_index_state
+from elasticsearch_app.utils import (
+    GENERATION_FORMAT,
+    INDEXED_MODELS,
+    concrete_indices,
+    generation_index_name,
+    generation_indices,
+    prune_generations,
+    remove_extraneous_documents,
+    swap_alias,
+    unfinished_generations
+)
+from geonode.people.models import Profile
 
 
 class Command(BaseCommand):
-    help = "Completely rebuilds the search index by removing the old data and then updating."
+    help = "Completely rebuilds the search index into new indices and then swaps them in."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of worker processes building and sending documents.'
+        )
+        parser.add_argument(
+            '--keep',
+            type=int,
+            default=1,
+            help='Number of previous generations of each index kept for rollback.'
+        )
+        parser.add_argument(
+            '--rollback',
+            action='store_true',
+            default=False,
+            help='Point every index back to its previous generation.'
+        )
+        parser.add_argument(
+            '--force-merge',
+            action='store_true',
+            default=False,
+            help='Merge each new index to one segment before swapping it in.'
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            default=False,
+            help='Continue the interrupted rebuild of the newest generation.'
+        )
 
     def handle(self, **options):
-        call_command('clear_index', **options)
-        call_command('update_index', **options)
+        '''
+        Builds every index into a new <index>-<generation> index, then
+        atomically swaps the aliases searched and written to, so searches
+        see the full old indices until the new ones are complete.
+        '''
+        es = get_client()
+        if options.get('rollback'):
+            return self.rollback(es)
+
+        if options.get('resume'):
+            generation = self.unfinished_generation(es)
+            if generation is None:
+                raise CommandError("No interrupted rebuild to resume")
+            started = min(
+                get_index_state(doctype._doc_type.index).checkpoint_started or
+                timezone.now()
+                for model, doctype in INDEXED_MODELS
+            )
+        else:
+            started = timezone.now()
+            generation = datetime.utcnow().strftime(GENERATION_FORMAT)
+            self.remove_unfinished_generations(es)
+        update_options = {
+            'workers': options.get('workers'),
+            'verbosity': options.get('verbosity')
+        }
+        try:
+            # The new generation isn't searched yet, so refreshes
+            # and replicas are only turned on once it is filled
+            call_command('update_index', generation=generation, bulk_load=True,
+                         force_merge=options.get('force_merge'),
+                         resume=options.get('resume'),
+                         **update_options)
+        except BaseException:
+            # The current generation stays in place, and the
+            # new one is kept to be continued with --resume
+            self.stderr.write(
+                "Rebuild of generation {} interrupted, run rebuild_index "
+                "--resume to continue it".format(generation)
+            )
+            raise
+
+        for model, doctype in INDEXED_MODELS:
+            alias = doctype._doc_type.index
+            swap_alias(es, alias, generation_index_name(alias, generation))
+            self.stdout.write("{0}: now {1}".format(
+                alias, generation_index_name(alias, generation)
+            ))
+            for index in prune_generations(es, alias, options.get('keep')):
+                self.stdout.write("{0}: removed {1}".format(alias, index))
+
+        # Saves and deletes are also written to the new generation, this
+        # catches up on changes that bypass signals, like queryset updates
+        for model, doctype in INDEXED_MODELS:
+            remove_extraneous_documents(es, model, doctype)
+            if model is Profile or get_modified_field(model) is not None:
+                index_pk_range(get_queryset(model, started), doctype, es)
+
+    def unfinished_generation(self, es):
+        '''
+        Gets the generation an interrupted rebuild was writing to
+        '''
+        alias = INDEXED_MODELS[0][1]._doc_type.index
+        unfinished = unfinished_generations(es, alias)
+        if not unfinished:
+            return None
+        return unfinished[-1][len(alias) + 1:]
+
+    def remove_unfinished_generations(self, es):
+        # An interrupted rebuild must not become a rollback target
+        for model, doctype in INDEXED_MODELS:
+            alias = doctype._doc_type.index
+            for index in unfinished_generations(es, alias):
+                es.indices.delete(index=index, ignore=404)
+                self.stdout.write("{0}: removed unfinished {1}".format(
+                    alias, index
+                ))
+
+    def rollback(self, es):
+        for model, doctype in INDEXED_MODELS:
+            alias = doctype._doc_type.index
+            current = concrete_indices(es, alias)
+            previous = [i for i in generation_indices(es, alias)
+                        if current and i < min(current)]
+            if not previous:
+                raise CommandError(
+                    "No previous generation to roll back to for {}".format(alias)
+                )
+            swap_alias(es, alias, previous[-1])
+            self.stdout.write("{0}: now {1}".format(alias, previous[-1]))
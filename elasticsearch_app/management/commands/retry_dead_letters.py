@@ -0,0 +1,115 @@
+# encoding: utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+
+from django.core.management.base import BaseCommand
+
+from elasticsearch_app import dead_letters
+from elasticsearch_app.client import get_client
+from elasticsearch_app.search import PermissionIndex, create_permission_index
+from elasticsearch_app.utils import INDEXED_MODELS, index_actions, send_bulk
+
+
+def retry_actions(model, doctype, ids, chunk_size=500):
+    '''
+    Builds the bulk actions of failed documents from the current
+    database rows, deleting the documents whose row is gone
+    :param model: The Django/GeoNode model
+    :param doctype: The doctype corresponding to the index
+    :param ids: The primary keys of the failed documents
+    :return: A generator of bulk action dicts
+    '''
+    ids = sorted(ids)
+    for i in range(0, len(ids), chunk_size):
+        chunk_ids = ids[i:i + chunk_size]
+        queryset = model.objects.filter(pk__in=chunk_ids)
+        found = set()
+        for action in index_actions(queryset, doctype, chunk_size):
+            found.add(int(action['_id']))
+            yield action
+        for id in chunk_ids:
+            if id not in found:
+                yield {
+                    '_op_type': 'delete',
+                    '_index': doctype._doc_type.index,
+                    '_type': doctype._doc_type.name,
+                    '_id': id
+                }
+
+
+def retry_permission_actions(principals):
+    '''
+    Builds the permission documents of users and groups again
+    :param principals: The permission document ids, e.g. user-5
+    :return: A generator of bulk action dicts
+    '''
+    for principal in sorted(principals):
+        kind, pk = principal.split('-', 1)
+        yield create_permission_index(kind, int(pk), save=False)
+
+
+class Command(BaseCommand):
+    help = "Indexes the documents that failed to index again from the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--list',
+            action='store_true',
+            default=False,
+            help='Only list the failed documents and their errors.'
+        )
+
+    def handle(self, **options):
+        '''
+        Takes the failed documents from the dead-letter file and indexes
+        them again in bulk. Documents that fail again are recorded anew.
+        '''
+        if options.get('list'):
+            for entry in dead_letters.read():
+                self.stdout.write("{failed} {index} {op_type} {id}: {error}".format(
+                    **entry
+                ))
+            return
+
+        entries = dead_letters.take()
+        ids = {}
+        for entry in entries:
+            # Failures of a rebuild are retried in the current generation
+            index = re.sub(r'-\d{14}$', '', entry['index'] or '')
+            # Permission documents are keyed by user or group
+            if index == PermissionIndex._doc_type.index:
+                ids.setdefault(index, set()).add(str(entry['id']))
+                continue
+            try:
+                ids.setdefault(index, set()).add(int(entry['id']))
+            except (TypeError, ValueError):
+                self.stderr.write("Skipped failed document {0} of {1}".format(
+                    entry['id'], index
+                ))
+
+        es = get_client()
+        principals = ids.pop(PermissionIndex._doc_type.index, None)
+        if principals:
+            indexed, errors = send_bulk(
+                es, retry_permission_actions(principals)
+            )
+            self.stdout.write("{0}: {1} retried, {2} failed again".format(
+                PermissionIndex._doc_type.index, indexed, len(errors)
+            ))
+        for model, doctype in INDEXED_MODELS:
+            index_ids = ids.pop(doctype._doc_type.index, None)
+            if not index_ids:
+                continue
+            indexed, errors = send_bulk(
+                es, retry_actions(model, doctype, index_ids)
+            )
+            self.stdout.write("{0}: {1} retried, {2} failed again".format(
+                doctype._doc_type.index, indexed, len(errors)
+            ))
+        for index in ids:
+            self.stderr.write("Skipped failed documents of unknown index {}".format(
+                index
+            ))
+        dead_letters.forget()
@@ -2,12 +2,22 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from django.core.management.base import BaseCommand
-from django.core.exceptions import ObjectDoesNotExist
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import Pool
+import cProfile
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
-from elasticsearch_app.utils import index_object
+from django.db import connections
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from elasticsearch_app.client import get_client
 
 geonode_imported = True
 try:
@@ -15,84 +25,605 @@ try:
     from geonode.maps.models import Map
     from geonode.documents.models import Document
     from geonode.people.models import Profile
-    from geonode.groups.models import GroupProfile
+    from elasticsearch_app import stats as index_stats
     from elasticsearch_app.search import (
-        LayerIndex,
-        MapIndex,
-        DocumentIndex,
-        ProfileIndex,
-        GroupIndex
+        IndexStateIndex,
+        PermissionIndex,
+        get_index_state
+    )
+    from elasticsearch_app.utils import (
+        INDEXED_MODELS,
+        BulkSender,
+        bulk_load,
+        concrete_indices,
+        generation_index_name,
+        index_action_chunks,
+        init_index,
+        remove_extraneous_documents,
+        skip_unchanged,
+        update_permission_index
     )
     geonode_imported = True
 except ImportError:
     geonode_imported = False
 
 
+# Failed documents listed in the output per index
+REPORTED_ERRORS = 10
+
+# Fields used to find the objects modified since the last run,
+# unless set for a model in settings.ES_MODIFIED_FIELDS
+MODIFIED_FIELDS = ('last_updated', 'last_modified')
+
+
+def get_modified_field(model):
+    modified_fields = getattr(settings, 'ES_MODIFIED_FIELDS', {})
+    if model._meta.model_name in modified_fields:
+        return modified_fields[model._meta.model_name]
+    field_names = [f.name for f in model._meta.get_fields()]
+    for field_name in MODIFIED_FIELDS:
+        if field_name in field_names:
+            return field_name
+    return None
+
+
+def get_queryset(model, since=None):
+    '''
+    Gets the objects of a model to index
+    :param model: The Django/GeoNode model
+    :param since: If set, only the objects modified after this time
+    :return: A queryset of the objects to index
+    '''
+    queryset = model.objects.all()
+    if since is None:
+        return queryset
+
+    field_name = get_modified_field(model)
+    if field_name is not None:
+        return queryset.filter(**{'{}__gt'.format(field_name): since})
+
+    if model is Profile:
+        # Profiles have no modification time, but their
+        # counts change with the resources they own
+        changed = Q(date_joined__gt=since)
+        for resource_model in (Layer, Map, Document):
+            changed |= Q(pk__in=get_queryset(resource_model, since).values(
+                'owner_id'))
+        return queryset.filter(changed)
+
+    # Without a modification time every object has to be indexed
+    return queryset
+
+
+def retarget(actions, index_name):
+    # Sends the documents to another index than the doctype's
+    for action in actions:
+        action['_index'] = index_name
+        yield action
+
+
+def index_pk_range(queryset, doctype, es, start=None, end=None,
+                   index_name=None, force=True, collect_stats=False,
+                   checkpoint=None, bulk_options=None):
+    '''
+    Indexes the objects of a queryset whose primary key is in [start, end]
+    :param queryset: The queryset of objects to index
+    :param doctype: The doctype corresponding to the index
+    :param es: The elasticsearch client to send the documents with
+    :param start: The first primary key of the range, None for no bound
+    :param end: The last primary key of the range, None for no bound
+    :param index_name: The index to write to, defaults to the doctype's
+    :param force: If False, skip documents whose indexed content is the same
+    :param collect_stats: If True, also return the stage timings
+        and database query count of the range
+    :param checkpoint: Called with the last primary key of every chunk
+        sent, until a chunk has failed documents
+    :param bulk_options: Options of the BulkSender, see utils.BulkSender
+    :return: A dict of indexed and failed document counts,
+        and the first failed documents' errors
+    '''
+    if collect_stats:
+        index_stats.start()
+        index_stats.instrument_client(es)
+    if start is not None:
+        queryset = queryset.filter(pk__gte=start)
+    if end is not None:
+        queryset = queryset.filter(pk__lte=end)
+    sender = BulkSender(es, **(bulk_options or {}))
+    # Chunks are sent in the order they were built
+    any_failed = [False]
+
+    def chunk_callback(last_pk):
+        def callback(failed):
+            any_failed[0] = any_failed[0] or failed > 0
+            # A resumed run starts after the checkpoint,
+            # so it must not skip failed documents
+            if checkpoint is not None and not any_failed[0]:
+                checkpoint(last_pk)
+        return callback
+
+    try:
+        try:
+            for last_pk, actions in index_action_chunks(queryset, doctype):
+                if index_name is not None:
+                    actions = retarget(actions, index_name)
+                if not force:
+                    actions = skip_unchanged(es, actions)
+                sender.send(actions, chunk_callback(last_pk))
+        finally:
+            indexed, errors = sender.close()
+    finally:
+        timings = index_stats.stop() if collect_stats else None
+    result = {
+        'indexed': indexed,
+        'failed': len(errors),
+        'errors': errors[:REPORTED_ERRORS]
+    }
+    if timings is not None:
+        result['timings'] = timings.to_dict()
+    return result
+
+
+def init_worker():
+    # Forked workers must not share the parent's database connections
+    connections.close_all()
+
+
+def index_pk_range_worker(task):
+    # Runs in a worker process, with its own database and
+    # elasticsearch connections
+    task = dict(task)
+    position = task.pop('position')
+    model, doctype = INDEXED_MODELS[position]
+    es = get_client()
+    queryset = get_queryset(model, task.pop('since'))
+    return position, task['start'], index_pk_range(queryset, doctype, es,
+                                                   **task)
+
+
+def pk_ranges(queryset, count):
+    '''
+    Splits the primary key space of a queryset into count ranges
+    :return: A list of (start, end) pairs
+    '''
+    bounds = queryset.aggregate(start=Min('pk'), end=Max('pk'))
+    if bounds['start'] is None:
+        return []
+    step = max(1, (bounds['end'] - bounds['start'] + count) // count)
+    return [(start, min(start + step - 1, bounds['end']))
+            for start in range(bounds['start'], bounds['end'] + 1, step)]
+
+
 class Command(BaseCommand):
     help = "Freshens the index for the given app(s)."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of worker processes building and sending documents.'
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            default=False,
+            help='Only index objects modified since the last successful run.'
+        )
+        parser.add_argument(
+            '--since',
+            help='Only index objects modified after this ISO 8601 date/time.'
+        )
+        parser.add_argument(
+            '--reconcile',
+            action='store_true',
+            default=False,
+            help='Also remove documents of deleted objects with --incremental '
+                 'or --since, which scans the ids of every index.'
+        )
+        parser.add_argument(
+            '--generation',
+            help='Build every index from scratch into a new '
+                 '<index>-<generation> index instead. Used by rebuild_index.'
+        )
+        parser.add_argument(
+            '--bulk-load',
+            action='store_true',
+            default=False,
+            help='Turn off refreshes and replicas of the indices while '
+                 'indexing. New documents are not searchable until the end.'
+        )
+        parser.add_argument(
+            '--force-merge',
+            action='store_true',
+            default=False,
+            help='Merge each index to one segment after a --bulk-load run.'
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            default=False,
+            help='Send every document, even if its indexed content is the same.'
+        )
+        parser.add_argument(
+            '--stats',
+            action='store_true',
+            default=False,
+            help='Report docs/sec, database queries and the time spent '
+                 'per preparation stage and bulk request.'
+        )
+        parser.add_argument(
+            '--stats-file',
+            help='Also write the --stats report to this JSON file.'
+        )
+        parser.add_argument(
+            '--profile',
+            help='Write a cProfile dump of the indexing to this file. '
+                 'Worker processes are not profiled.'
+        )
+        parser.add_argument(
+            '--bulk-size',
+            type=int,
+            help='Maximum documents per bulk request, '
+                 'defaults to settings.ES_BULK_CHUNK_SIZE or 500.'
+        )
+        parser.add_argument(
+            '--bulk-bytes',
+            type=int,
+            help='Maximum bytes per bulk request, '
+                 'defaults to settings.ES_BULK_MAX_CHUNK_BYTES or 10MB.'
+        )
+        parser.add_argument(
+            '--bulk-threads',
+            type=int,
+            help='Bulk requests in flight per process, '
+                 'defaults to settings.ES_BULK_THREADS or 2.'
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            default=False,
+            help='Continue an interrupted run after the last primary key '
+                 'it sent for each index.'
+        )
+
     def handle(self, **options):
         '''
         Removes any extraneous data not matched in Django data.
         Repopulates the indices in elastic with current Django data.
         '''
-        es = Elasticsearch(settings.ES_URL)
+        es = get_client()
+        generation = options.get('generation')
 
         # Any indices added in search.py should be initialized here
         if geonode_imported:
-            LayerIndex.init()
-            MapIndex.init()
-            DocumentIndex.init()
-            ProfileIndex.init()
-            GroupIndex.init()
-
-        body = {
-            'analysis': {
-                'analyzer': 'snowball'
-            }
-        }
-        es.indices.put_settings(body, index='', ignore=400)
-
-        def remove_extraneous_elements(index, model, doctype):
-            '''
-            Removes any items that exist in a GeoNode index which
-            no longer exist in Django
-            :param index: The string name of the index in elasticsearch
-            :param model: The Django/GeoNode model
-            :param doctype: The doctype corresponding to the index
-            :return:
-            '''
-            indexed_items = es.search(index=index)
-
-            for item in indexed_items['hits']['hits']:
-                model_id = item['_id']
-                try:
-                    model.objects.get(id=model_id)
-                except ObjectDoesNotExist:
-                    doctype.get(id=model_id).delete()
-
-        # Any indices containing extraneous data should be removed here
-        if geonode_imported:
-            remove_extraneous_elements('layer-index', Layer, LayerIndex)
-            remove_extraneous_elements('map-index', Map, MapIndex)
-            remove_extraneous_elements('document-index', Document, DocumentIndex)
-            remove_extraneous_elements('profile-index', Profile, ProfileIndex)
-            remove_extraneous_elements('group-index', GroupProfile, GroupIndex)
+            IndexStateIndex.init()
+            PermissionIndex.init()
+            index_names = []
+            for model, doctype in INDEXED_MODELS:
+                if generation:
+                    index_name = generation_index_name(
+                        doctype._doc_type.index, generation
+                    )
+                    doctype.init(index=index_name)
+                else:
+                    index_name = None
+                    init_index(es, doctype)
+                index_names.append(index_name)
 
-        # Any indices added in search.py should be indexed here
+        # Documents are only built here and sent to elasticsearch once
+        # through the bulk helper, preparing each chunk of objects together.
         if geonode_imported:
-            bulk(client=es,
-                 actions=(index_object(layer, LayerIndex)
-                          for layer in Layer.objects.all().iterator()))
-            bulk(client=es,
-                 actions=(index_object(map_obj, MapIndex)
-                          for map_obj in Map.objects.all().iterator()))
-            bulk(client=es,
-                 actions=(index_object(document, DocumentIndex)
-                          for document in Document.objects.all().iterator()))
-            bulk(client=es,
-                 actions=(index_object(profile, ProfileIndex)
-                          for profile in Profile.objects.all().iterator()))
-            bulk(client=es,
-                 actions=(index_object(group, GroupIndex)
-                          for group in GroupProfile.objects.all().iterator()))
+            # Objects changed while this runs will be picked up next time
+            run_started = timezone.now()
+            if generation:
+                since = [None] * len(INDEXED_MODELS)
+            else:
+                since = self.get_since(options)
+            starts = self.start_checkpoints(options, index_names, since,
+                                            run_started)
+
+            for position, (model, doctype) in enumerate(INDEXED_MODELS):
+                if (since[position] is not None and model is not Profile and
+                        get_modified_field(model) is None):
+                    self.stdout.write(
+                        "{0}: {1} has no modification field, indexing every "
+                        "object. Set one in ES_MODIFIED_FIELDS.".format(
+                            doctype._doc_type.index, model._meta.model_name
+                        )
+                    )
+
+            # Any indices containing extraneous data should be removed here.
+            # A new generation starts empty, and runs limited to recently
+            # modified objects skip the full scan unless asked for it.
+            if not generation:
+                reconcile = options.get('reconcile')
+                for position, (model, doctype) in enumerate(INDEXED_MODELS):
+                    if since[position] is not None and not reconcile:
+                        continue
+                    removed = remove_extraneous_documents(es, model, doctype)
+                    if removed:
+                        self.stdout.write("{0}: removed {1} extraneous documents".format(
+                            doctype._doc_type.index, removed
+                        ))
+
+            tasks = []
+            for position, (model, doctype) in enumerate(INDEXED_MODELS):
+                tasks.append({
+                    'position': position,
+                    'since': since[position],
+                    'start': starts[position],
+                    'index_name': index_names[position],
+                    # A new generation is empty, so there is nothing to compare to
+                    'force': bool(options.get('force') or generation),
+                    'collect_stats': bool(options.get('stats') or
+                                          options.get('stats_file')),
+                    'bulk_options': {
+                        'chunk_size': options.get('bulk_size'),
+                        'max_chunk_bytes': options.get('bulk_bytes'),
+                        'thread_count': options.get('bulk_threads')
+                    }
+                })
+
+            workers = max(1, options.get('workers') or 1)
+            profile = cProfile.Profile() if options.get('profile') else None
+            if profile is not None:
+                profile.enable()
+            try:
+                with self.bulk_load(es, options, index_names):
+                    if workers > 1:
+                        results = self.index_parallel(workers, tasks)
+                    else:
+                        results = self.index_serial(es, tasks)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                    profile.dump_stats(options['profile'])
+            self.write_results(results)
+            if options.get('stats') or options.get('stats_file'):
+                self.write_stats(results, options.get('stats_file'))
+            self.save_watermarks(results)
+
+            # Searches filter through these with ES_PERMISSION_FILTER = 'lookup'
+            if getattr(settings, 'ES_PERMISSION_FILTER', 'acl') == 'lookup':
+                indexed, removed, errors = update_permission_index(es)
+                self.stdout.write("{0}: {1} indexed, {2} removed, {3} failed".format(
+                    PermissionIndex._doc_type.index, indexed, removed, len(errors)
+                ))
+
+    @contextmanager
+    def bulk_load(self, es, options, index_names):
+        if not options.get('bulk_load'):
+            yield
+            return
+        indices = []
+        for (model, doctype), index_name in zip(INDEXED_MODELS, index_names):
+            if index_name is not None:
+                indices.append(index_name)
+            else:
+                indices.extend(concrete_indices(es, doctype._doc_type.index))
+        with bulk_load(es, indices, force_merge=options.get('force_merge')):
+            yield
+
+    def get_since(self, options):
+        '''
+        Gets the time after which modified objects are indexed for
+        every index, None where every object is indexed.
+        '''
+        since = None
+        if options.get('since'):
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError(
+                    "Invalid --since date/time: {}".format(options['since'])
+                )
+            if settings.USE_TZ and timezone.is_naive(since):
+                since = timezone.make_aware(since)
+
+        watermarks = []
+        for model, doctype in INDEXED_MODELS:
+            watermark = since
+            if watermark is None and options.get('incremental'):
+                watermark = get_index_state(doctype._doc_type.index).watermark
+            watermarks.append(watermark)
+        return watermarks
+
+    def start_checkpoints(self, options, index_names, since, run_started):
+        '''
+        Starts a new checkpoint for every index, or with --resume continues
+        the checkpoint of an interrupted run that wrote to the same index.
+        Updates since to the resumed runs' since.
+        :return: The primary key to start from for every index
+        '''
+        self.states = []
+        starts = []
+        for position, (model, doctype) in enumerate(INDEXED_MODELS):
+            state = get_index_state(doctype._doc_type.index)
+            index_name = index_names[position] or doctype._doc_type.index
+            if (options.get('resume') and
+                    state.checkpoint_started is not None and
+                    state.checkpoint_index == index_name):
+                since[position] = state.checkpoint_since
+                start = None
+                if state.checkpoint is not None:
+                    start = state.checkpoint + 1
+                    self.stdout.write("{0}: resuming after {1}".format(
+                        doctype._doc_type.index, state.checkpoint
+                    ))
+            else:
+                state.checkpoint = None
+                state.checkpoint_index = index_name
+                state.checkpoint_since = since[position]
+                state.checkpoint_started = run_started
+                state.save()
+                start = None
+            self.states.append(state)
+            starts.append(start)
+        return starts
+
+    def save_checkpoint(self, position, pk):
+        state = self.states[position]
+        state.checkpoint = pk
+        state.save()
+
+    def save_watermarks(self, results):
+        for state, result in zip(self.states, results):
+            # Don't skip past documents that failed to index,
+            # nor changes made while an interrupted run was going on
+            if result['failed'] != 0:
+                continue
+            # Objects modified between the watermark and a later --since
+            # weren't indexed, so only a run covering them moves it on
+            since = state.checkpoint_since
+            if since is None or (state.watermark is not None and
+                                 since <= state.watermark):
+                state.watermark = state.checkpoint_started
+            state.checkpoint = None
+            state.checkpoint_index = None
+            state.checkpoint_since = None
+            state.checkpoint_started = None
+            state.save()
+
+    def index_serial(self, es, tasks):
+        results = []
+        for task in tasks:
+            task = dict(task)
+            position = task.pop('position')
+            model, doctype = INDEXED_MODELS[position]
+            start_time = time.time()
+            queryset = get_queryset(model, task.pop('since'))
+            result = index_pk_range(
+                queryset, doctype, es,
+                checkpoint=partial(self.save_checkpoint, position),
+                **task
+            )
+            result['seconds'] = time.time() - start_time
+            results.append(result)
+        return results
+
+    def index_parallel(self, workers, tasks):
+        '''
+        Splits every model's primary key space into ranges and indexes
+        the ranges in a pool of worker processes. The checkpoint of
+        a model moves to the end of the ranges finished in order.
+        '''
+        # More ranges than workers keeps the pool busy when
+        # primary keys are unevenly distributed
+        range_tasks = []
+        pending = []
+        for task in tasks:
+            model, doctype = INDEXED_MODELS[task['position']]
+            queryset = get_queryset(model, task['since'])
+            if task['start'] is not None:
+                queryset = queryset.filter(pk__gte=task['start'])
+            ranges = pk_ranges(queryset, workers * 4)
+            for start, end in ranges:
+                range_task = dict(task, start=start, end=end)
+                range_tasks.append(range_task)
+            pending.append(deque(ranges))
+        finished = [set() for _ in INDEXED_MODELS]
+
+        results = [{'indexed': 0, 'failed': 0, 'errors': [], 'seconds': 0.0}
+                   for _ in INDEXED_MODELS]
+        # Close the connections so they are not shared with the workers
+        connections.close_all()
+        start_time = time.time()
+        pool = Pool(workers, initializer=init_worker)
+        try:
+            for position, start, range_result in pool.imap_unordered(
+                    index_pk_range_worker, range_tasks):
+                if range_result['failed'] == 0:
+                    finished[position].add(start)
+                    checkpoint = None
+                    while (pending[position] and
+                           pending[position][0][0] in finished[position]):
+                        checkpoint = pending[position].popleft()[1]
+                    if checkpoint is not None:
+                        self.save_checkpoint(position, checkpoint)
+                result = results[position]
+                result['indexed'] += range_result['indexed']
+                result['failed'] += range_result['failed']
+                result['errors'] = (result['errors'] +
+                                    range_result['errors'])[:REPORTED_ERRORS]
+                result['seconds'] = time.time() - start_time
+                if 'timings' in range_result:
+                    timings = index_stats.Timings()
+                    if 'timings' in result:
+                        timings.merge(result['timings'])
+                    timings.merge(range_result['timings'])
+                    result['timings'] = timings.to_dict()
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return results
+
+    def write_results(self, results):
+        for (model, doctype), result in zip(INDEXED_MODELS, results):
+            self.stdout.write(
+                "{0}: {1} indexed, {2} failed in {3:.1f}s".format(
+                    doctype._doc_type.index,
+                    result['indexed'],
+                    result['failed'],
+                    result['seconds']
+                )
+            )
+            for error in result['errors']:
+                self.stderr.write("{0}: {1}".format(
+                    doctype._doc_type.index, error
+                ))
+            if result['failed'] > len(result['errors']):
+                self.stderr.write("{0}: {1} more failed".format(
+                    doctype._doc_type.index,
+                    result['failed'] - len(result['errors'])
+                ))
+
+    def write_stats(self, results, stats_file=None):
+        '''
+        Prints the throughput of every index and the time spent per
+        stage as tables, and optionally writes them as JSON.
+        '''
+        report = {'indices': {}, 'stages': {}}
+        totals = index_stats.Timings()
+        for (model, doctype), result in zip(INDEXED_MODELS, results):
+            timings = result.get('timings', {'queries': 0, 'stages': {}})
+            totals.merge(timings)
+            seconds = result['seconds']
+            report['indices'][doctype._doc_type.index] = {
+                'indexed': result['indexed'],
+                'failed': result['failed'],
+                'seconds': seconds,
+                'docs_per_second': result['indexed'] / seconds if seconds else 0.0,
+                'queries': timings['queries']
+            }
+        for name, (calls, seconds) in totals.stages.items():
+            report['stages'][name] = {'calls': calls, 'seconds': seconds}
+
+        row = "{0:<20} {1:>10} {2:>8} {3:>10} {4:>10} {5:>10}"
+        self.stdout.write(row.format(
+            'index', 'indexed', 'failed', 'seconds', 'docs/sec', 'queries'
+        ))
+        for index, index_report in sorted(report['indices'].items()):
+            self.stdout.write(row.format(
+                index,
+                index_report['indexed'],
+                index_report['failed'],
+                '{0:.1f}'.format(index_report['seconds']),
+                '{0:.1f}'.format(index_report['docs_per_second']),
+                index_report['queries']
+            ))
+
+        row = "{0:<32} {1:>10} {2:>10}"
+        self.stdout.write('')
+        self.stdout.write(row.format('stage', 'calls', 'seconds'))
+        for name, stage in sorted(report['stages'].items(),
+                                  key=lambda item: -item[1]['seconds']):
+            self.stdout.write(row.format(
+                name, stage['calls'], '{0:.2f}'.format(stage['seconds'])
+            ))
+
+        if stats_file:
+            with open(stats_file, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
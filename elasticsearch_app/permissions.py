@@ -0,0 +1,53 @@
+from array import array
+
+from django.conf import settings
+from django.core.cache import cache
+from guardian.shortcuts import get_objects_for_user
+
+# Bumped whenever what any user may view can have changed,
+# which invalidates every cached set of visible resources
+VERSION_KEY = 'elasticsearch_app:permissions_version'
+
+
+def permissions_version():
+    # add only sets the key if it doesn't exist yet
+    cache.add(VERSION_KEY, 1, None)
+    return cache.get(VERSION_KEY, 1)
+
+
+def permissions_cached():
+    # Only the 'ids' permission filter reads the cache
+    return getattr(settings, 'ES_PERMISSION_FILTER', 'acl') == 'ids'
+
+
+def invalidate_permissions():
+    '''
+    Invalidates the cached visible resources of every user
+    '''
+    cache.add(VERSION_KEY, 1, None)
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # Evicted in between
+        cache.set(VERSION_KEY, 1, None)
+
+
+def visible_resource_ids(user):
+    '''
+    Gets the ids of the resources a user may view, cached per user
+    for settings.ES_PERMISSION_CACHE_TTL seconds (default 3600) until
+    permissions or resources change.
+    :param user: The user, anonymous or not
+    :return: A sorted array of resource ids
+    '''
+    key = 'elasticsearch_app:visible_resources:{0}:{1}'.format(
+        permissions_version(),
+        user.pk or 'anonymous'
+    )
+    ids = cache.get(key)
+    if ids is None:
+        filter_set = get_objects_for_user(user, 'base.view_resourcebase')
+        # An array of ints pickles far smaller than a list
+        ids = array('l', sorted(filter_set.values_list('id', flat=True)))
+        cache.set(key, ids, getattr(settings, 'ES_PERMISSION_CACHE_TTL', 3600))
+    return ids
@@ -16,23 +16,44 @@ from django.conf import settings
 from geonode.layers.models import Layer
 from geonode.maps.models import Map
 from geonode.documents.models import Document
+from geonode.base.models import Link, ResourceBase
 from guardian.shortcuts import get_objects_for_user
+from guardian.models import UserObjectPermission, GroupObjectPermission
+from guardian.utils import get_anonymous_user
 from avatar.templatetags.avatar_tags import avatar_url
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
 from agon_ratings.models import OverallRating
 from dialogos.models import Comment
-from django.db.models import Avg
+from django.db.models import Avg, Count, Prefetch, Q
 from django.core.exceptions import ObjectDoesNotExist
 from geonode.services.enumerations import INDEXED
 from six.moves.urllib_parse import urlparse
 from geonode.utils import bbox_to_projection
 from elasticsearch import TransportError
+from django.contrib.gis.gdal import (
+    CoordTransform,
+    GDALException,
+    OGRGeometry,
+    SpatialReference
+)
+from django.contrib.gis.gdal.error import SRSException
+from collections import OrderedDict
+from itertools import chain
+from math import isinf, isnan
+import hashlib
+import json
+import threading
 import logging
+from elasticsearch_app import dead_letters
+from elasticsearch_app.client import LazyClient
+from elasticsearch_app.stats import timed
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
-connections.create_connection(hosts=[settings.ES_URL])
+connections.add_connection('default', LazyClient())
 
 pattern_analyzer = analyzer(
   'pattern_analyzer',
@@ -42,6 +63,30 @@ pattern_analyzer = analyzer(
 )
 
 
+# List fields whose order comes from unordered relations
+UNORDERED_FIELDS = ('keywords', 'regions', 'references')
+
+
+def sort_key(value):
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+@timed
+def document_hash(obj):
+    '''
+    A stable hash of a document's source fields, used to
+    skip sending documents that didn't change.
+    '''
+    source = obj.to_dict()
+    source.pop('content_hash', None)
+    for name in UNORDERED_FIELDS:
+        if isinstance(source.get(name), list):
+            source[name] = sorted(source[name], key=sort_key)
+    serialized = json.dumps(source, sort_keys=True, default=str,
+                            separators=(',', ':'))
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
 # Functions used to prepare columns for index
 def float_or_none(val):
     try:
@@ -50,31 +95,162 @@ def float_or_none(val):
         return None
 
 
-def prepare_bbox(resource):
-    bbox = resource.bbox[:4]
+class LRUCache(object):
+    '''
+    A small thread safe least recently used cache.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            # Re-insert to mark as most recently used
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+# Remote service layers often share extents, so the
+# reprojection of (bbox, srid) pairs is memoized
+bbox_cache = LRUCache(getattr(settings, 'ES_BBOX_CACHE_SIZE', 10000))
+# OGR transforms are not thread safe, so they are cached per thread
+transform_cache = threading.local()
+BBOX_NOT_CACHED = object()
+
+
+def srid_to_int(srid):
+    # srids are stored both as 'EPSG:4326' and as 4326
+    srid = str(srid)
+    if ':' in srid:
+        srid = srid.split(':')[1]
+    return int(srid)
+
+
+def get_transform(source_srid):
+    transforms = getattr(transform_cache, 'transforms', None)
+    if transforms is None:
+        transforms = transform_cache.transforms = {}
+    if source_srid not in transforms:
+        transforms[source_srid] = CoordTransform(
+            SpatialReference(source_srid),
+            SpatialReference(4326)
+        )
+    return transforms[source_srid]
+
+
+def bbox_source_srid(resource):
     source_srid = None
     if hasattr(resource, 'storeType'):
         if resource.storeType == "remoteStore":
             source_srid = resource.service.srid
     if source_srid is None:
         source_srid = resource.srid
-    # Elasticsearch needs all bbox values to conform to EPSG:4326
-    reprojected_bbox = bbox
-    # Only reproject if bbox contains real values
-    if None not in bbox:
-        reprojected_bbox = bbox_to_projection(bbox, source_srid=source_srid,
-                                              target_srid=4326)
-        # If last element is not srid, then it contains error message
-        if 'EPSG' not in reprojected_bbox[4]:
-            logger.warn(reprojected_bbox[4])
-            # Because the reprojection failed, there's no reliable way
-            # to translate the bbox to something usable, so just fail
-            return None
-
-    minx = float_or_none(reprojected_bbox[0])
-    miny = float_or_none(reprojected_bbox[1])
-    maxx = float_or_none(reprojected_bbox[2])
-    maxy = float_or_none(reprojected_bbox[3])
+    return source_srid
+
+
+@timed
+def reproject_bbox(bbox, source_srid):
+    '''
+    Reprojects a single bbox with geonode.utils.bbox_to_projection.
+    :return: The reprojected bbox, or None if the reprojection failed
+    '''
+    reprojected_bbox = bbox_to_projection(bbox, source_srid=source_srid,
+                                          target_srid=4326)
+    # If last element is not srid, then it contains error message
+    if 'EPSG' not in reprojected_bbox[4]:
+        logger.warn(reprojected_bbox[4])
+        return None
+    return tuple(reprojected_bbox[:4])
+
+
+def transform_bbox_group(bboxes, source_srid):
+    '''
+    Reprojects bboxes sharing a source srid to EPSG:4326 by transforming
+    all of their corners in one call with a cached transform.
+    Falls back to reproject_bbox for the bboxes that can't be transformed
+    that way, so errors are reported the same as for a single bbox.
+    :param bboxes: A list of GeoNode bboxes, [minx, maxx, miny, maxy]
+    :param source_srid: The srid the bboxes are in
+    :return: A list of reprojected (minx, miny, maxx, maxy) tuples
+        like bbox_to_projection returns, None where reprojection failed
+    '''
+    try:
+        srid = srid_to_int(source_srid)
+        corners = []
+        for bbox in bboxes:
+            minx, maxx, miny, maxy = [float(v) for v in bbox]
+            corners.extend([(minx, miny), (minx, maxy),
+                            (maxx, miny), (maxx, maxy)])
+        points = OGRGeometry('MULTIPOINT ({0})'.format(', '.join(
+            '{0!r} {1!r}'.format(x, y) for x, y in corners
+        )))
+        if srid != 4326:
+            points.transform(get_transform(srid))
+        coords = points.coords
+    except (GDALException, SRSException, TypeError, ValueError):
+        # e.g. an srid unknown to GDAL, such as EPSG:900913
+        return [reproject_bbox(bbox, source_srid) for bbox in bboxes]
+
+    results = []
+    for i, bbox in enumerate(bboxes):
+        xs = [c[0] for c in coords[i * 4:i * 4 + 4]]
+        ys = [c[1] for c in coords[i * 4:i * 4 + 4]]
+        reprojected_bbox = (min(xs), min(ys), max(xs), max(ys))
+        if not any(isinf(v) or isnan(v) for v in reprojected_bbox):
+            results.append(reprojected_bbox)
+        else:
+            results.append(reproject_bbox(bbox, source_srid))
+    return results
+
+
+@timed
+def reproject_bboxes(bboxes):
+    '''
+    Reprojects many bboxes to EPSG:4326, grouped by source srid.
+    :param bboxes: A list of (bbox, source_srid) pairs
+    :return: A list of reprojected bboxes in the same order,
+        None where the reprojection failed
+    '''
+    results = [None] * len(bboxes)
+    groups = {}
+    for i, (bbox, source_srid) in enumerate(bboxes):
+        cached = bbox_cache.get((tuple(bbox), source_srid), BBOX_NOT_CACHED)
+        if cached is BBOX_NOT_CACHED:
+            groups.setdefault(source_srid, []).append(i)
+        else:
+            results[i] = cached
+
+    for source_srid, positions in groups.items():
+        reprojected_bboxes = transform_bbox_group(
+            [bboxes[i][0] for i in positions],
+            source_srid
+        )
+        for i, reprojected_bbox in zip(positions, reprojected_bboxes):
+            # Failures aren't cached, so every resource reports its own
+            if reprojected_bbox is not None:
+                bbox_cache.set((tuple(bboxes[i][0]), source_srid),
+                               reprojected_bbox)
+            results[i] = reprojected_bbox
+    return results
+
+
+def bbox_to_geoshape(bbox):
+    minx = float_or_none(bbox[0])
+    miny = float_or_none(bbox[1])
+    maxx = float_or_none(bbox[2])
+    maxy = float_or_none(bbox[3])
     if (minx and maxx and miny and maxy and
             minx < maxx and miny < maxy):
         geoshape = {
@@ -85,6 +261,42 @@ def prepare_bbox(resource):
     return None
 
 
+@timed
+def prepare_bboxes(resources):
+    '''
+    Prepares the bbox of a chunk of resources, reprojecting them together.
+    :return: A dict of primary key to prepared bbox
+    '''
+    prepared = {}
+    to_reproject = []
+    for resource in resources:
+        bbox = resource.bbox[:4]
+        # Only reproject if bbox contains real values
+        if None in bbox:
+            prepared[resource.pk] = None
+        else:
+            to_reproject.append(
+                (resource.pk, (bbox, bbox_source_srid(resource)))
+            )
+
+    reprojected_bboxes = reproject_bboxes([r[1] for r in to_reproject])
+    for (pk, _), reprojected_bbox in zip(to_reproject, reprojected_bboxes):
+        # Because the reprojection failed, there's no reliable way
+        # to translate the bbox to something usable, so just fail
+        if reprojected_bbox is None:
+            prepared[pk] = None
+        else:
+            prepared[pk] = bbox_to_geoshape(reprojected_bbox)
+    return prepared
+
+
+@timed
+def prepare_bbox(resource):
+    # Elasticsearch needs all bbox values to conform to EPSG:4326
+    return prepare_bboxes([resource])[resource.pk]
+
+
+@timed
 def prepare_rating(resource):
     ct = ContentType.objects.get_for_model(resource)
     try:
@@ -97,6 +309,7 @@ def prepare_rating(resource):
         return 0.0
 
 
+@timed
 def prepare_num_ratings(resource):
     ct = ContentType.objects.get_for_model(resource)
     try:
@@ -108,6 +321,7 @@ def prepare_num_ratings(resource):
         return 0
 
 
+@timed
 def prepare_num_comments(resource):
     ct = ContentType.objects.get_for_model(resource)
     try:
@@ -119,10 +333,231 @@ def prepare_num_comments(resource):
         return 0
 
 
+@timed
+def prepare_resource_counts(model, ids):
+    '''
+    Computes rating, num_ratings and num_comments for a chunk of
+    resources of the same model. Uses one grouped query for ratings and
+    one for comments instead of three queries per resource.
+    :param model: The Django/GeoNode model of the resources
+    :param ids: The primary keys of the resources
+    :return: A dict of primary key to prepared values
+    '''
+    ct = ContentType.objects.get_for_model(model)
+    prepared = {}
+    for pk in ids:
+        prepared[pk] = {'rating': 0.0, 'num_ratings': 0, 'num_comments': 0}
+
+    ratings = OverallRating.objects.filter(
+        object_id__in=ids,
+        content_type=ct
+    ).order_by().values('object_id').annotate(
+        r=Avg('rating'),
+        n=Count('id')
+    )
+    for row in ratings:
+        if row['object_id'] in prepared:
+            prepared[row['object_id']].update({
+                'rating': float(str(row['r'] or "0")),
+                'num_ratings': row['n']
+            })
+
+    comments = Comment.objects.filter(
+        object_id__in=ids,
+        content_type=ct
+    ).order_by().values('object_id').annotate(n=Count('id'))
+    for row in comments:
+        if row['object_id'] in prepared:
+            prepared[row['object_id']]['num_comments'] = row['n']
+
+    return prepared
+
+
+def visible_counts(ctype_counts):
+    '''
+    Converts (polymorphic_ctype, count) pairs to the counts of a ProfileIndex
+    '''
+    ctypes = ContentType.objects.get_for_models(Layer, Map, Document)
+    count_names = {
+        ctypes[Layer].id: 'layers_count',
+        ctypes[Map].id: 'maps_count',
+        ctypes[Document].id: 'documents_count'
+    }
+    counts = dict((name, 0) for name in count_names.values())
+    for ctype_id, count in ctype_counts:
+        if ctype_id in count_names:
+            counts[count_names[ctype_id]] += count
+    return counts
+
+
+@timed
+def prepare_visible_counts(profile):
+    '''
+    Counts the layers, maps and documents a profile can view
+    with one grouped query.
+    '''
+    return visible_counts(get_objects_for_user(
+        profile,
+        'base.view_resourcebase'
+    ).order_by().values_list('polymorphic_ctype').annotate(n=Count('pk')))
+
+
+@timed
+def prepare_profile_counts(profiles):
+    '''
+    Counts the layers, maps and documents every profile of a chunk can view.
+    Gives the same counts as get_objects_for_user(profile,
+    'base.view_resourcebase') with a few queries for the whole chunk,
+    reading the guardian permission tables directly.
+    :param profiles: A list of profiles
+    :return: A dict of primary key to prepared counts
+    '''
+    perm = view_permission()
+    ids = [p.pk for p in profiles]
+    prepared = {}
+
+    # Superusers and users with the global permission can view everything
+    global_ids = set(p.pk for p in profiles if p.is_superuser)
+    global_ids.update(get_user_model().objects.filter(
+        pk__in=ids,
+        is_active=True
+    ).filter(
+        Q(user_permissions=perm) | Q(groups__permissions=perm)
+    ).values_list('pk', flat=True))
+    if global_ids:
+        counts = visible_counts(ResourceBase.objects.order_by().values_list(
+            'polymorphic_ctype').annotate(n=Count('pk')))
+        for pk in global_ids:
+            prepared[pk] = counts
+
+    ids = [pk for pk in ids if pk not in global_ids]
+    if not ids:
+        return prepared
+
+    # Object permissions are kept per group, so objects shared
+    # with a large group are only held in memory once
+    user_pks = dict((pk, set()) for pk in ids)
+    user_groups = dict((pk, set()) for pk in ids)
+    group_pks = {}
+    for user_id, object_pk in UserObjectPermission.objects.filter(
+            permission=perm, user__in=ids).values_list('user', 'object_pk'):
+        user_pks[user_id].add(int(object_pk))
+    for user_id, group_id in get_user_model().groups.through.objects.filter(
+            user__in=ids).values_list('user', 'group'):
+        user_groups[user_id].add(group_id)
+    group_ids = set(chain.from_iterable(user_groups.values()))
+    for group_id, object_pk in GroupObjectPermission.objects.filter(
+            permission=perm, group__in=group_ids).values_list(
+            'group', 'object_pk'):
+        group_pks.setdefault(group_id, set()).add(int(object_pk))
+
+    object_pks = sorted(set(chain.from_iterable(
+        chain(user_pks.values(), group_pks.values())
+    )))
+    ctype_of = {}
+    for i in range(0, len(object_pks), 1000):
+        ctype_of.update(ResourceBase.objects.filter(
+            pk__in=object_pks[i:i + 1000]
+        ).values_list('pk', 'polymorphic_ctype'))
+
+    for pk in ids:
+        visible = set(user_pks[pk])
+        for group_id in user_groups[pk]:
+            visible.update(group_pks.get(group_id, ()))
+        prepared[pk] = visible_counts(
+            (ctype_of[object_pk], 1) for object_pk in visible
+            if object_pk in ctype_of
+        )
+    return prepared
+
+
+def view_permission():
+    return Permission.objects.get(
+        content_type__app_label='base',
+        codename='view_resourcebase'
+    )
+
+
+@timed
+def prepare_read_permissions(ids):
+    '''
+    Lists the users and groups that can view each resource of a chunk,
+    with one query per guardian permission table. A resource the
+    anonymous user or group can view is public.
+    :param ids: The primary keys of the resources
+    :return: A dict of primary key to read_users, read_groups and public
+    '''
+    perm = view_permission()
+    anonymous_user_id = get_anonymous_user().pk
+    prepared = {}
+    for pk in ids:
+        prepared[pk] = {'read_users': set(), 'read_groups': set(), 'public': False}
+    object_pks = [str(pk) for pk in ids]
+
+    for user_id, object_pk in UserObjectPermission.objects.filter(
+            permission=perm, object_pk__in=object_pks).values_list(
+            'user', 'object_pk'):
+        permissions = prepared.get(int(object_pk))
+        if permissions is not None:
+            permissions['read_users'].add(user_id)
+            if user_id == anonymous_user_id:
+                permissions['public'] = True
+    for group_id, group_name, object_pk in GroupObjectPermission.objects.filter(
+            permission=perm, object_pk__in=object_pks).values_list(
+            'group', 'group__name', 'object_pk'):
+        permissions = prepared.get(int(object_pk))
+        if permissions is not None:
+            permissions['read_groups'].add(group_id)
+            if group_name == 'anonymous':
+                permissions['public'] = True
+
+    # Sorted, so the content hash only changes with the permissions
+    for permissions in prepared.values():
+        for name in ('read_users', 'read_groups'):
+            permissions[name] = [str(i) for i in sorted(permissions[name])]
+    return prepared
+
+
+def prepare_permissions(resource):
+    return prepare_read_permissions([resource.pk])[resource.pk]
+
+
+@timed
+def prepare_chunk(model, resources):
+    '''
+    Prepares the expensive columns for a whole chunk of resources at once.
+    The result can be passed to the create_*_index functions through
+    their prepared argument.
+    :param model: The Django/GeoNode model of the resources
+    :param resources: A list of model instances
+    :return: A dict of primary key to prepared values
+    '''
+    if model is get_user_model():
+        return prepare_profile_counts(resources)
+    if model not in (Layer, Map, Document):
+        return {}
+    prepared = prepare_resource_counts(model, [r.pk for r in resources])
+    for pk, bbox in prepare_bboxes(resources).items():
+        prepared[pk]['bbox'] = bbox
+    for pk, permissions in prepare_read_permissions(list(prepared)).items():
+        prepared[pk]['permissions'] = permissions
+    return prepared
+
+
+def prepared_value(prepared, name, prepare, resource):
+    # Use the batch prepared value if there is one,
+    # otherwise prepare it for this resource alone
+    if prepared is not None and name in prepared:
+        return prepared[name]
+    return prepare(resource)
+
+
+@timed
 def prepare_title_sortable(resource):
     return prepare_title(resource).lower()
 
 
+@timed
 def prepare_category(resource):
     if resource.category:
         return resource.category.identifier
@@ -135,6 +570,7 @@ def prepare_category(resource):
     return None
 
 
+@timed
 def prepare_category_gn_description(resource):
     if resource.category:
         return resource.category.gn_description
@@ -142,11 +578,13 @@ def prepare_category_gn_description(resource):
         return None
 
 
+@timed
 def prepare_supplemental_information(resource):
     # For some reason this isn't a string
     return str(resource.supplemental_information)
 
 
+@timed
 def prepare_owner(resource):
     if resource.owner:
         return resource.owner.username
@@ -154,6 +592,7 @@ def prepare_owner(resource):
         return None
 
 
+@timed
 def prepare_owner_first(resource):
     if resource.owner.first_name:
         return resource.owner.first_name
@@ -161,6 +600,7 @@ def prepare_owner_first(resource):
         return None
 
 
+@timed
 def prepare_owner_last(resource):
     if resource.owner.last_name:
         return resource.owner.last_name
@@ -168,6 +608,7 @@ def prepare_owner_last(resource):
         return None
 
 
+@timed
 def prepare_source_host(resource):
     if resource.service is not None and resource.service.method == INDEXED:
         return urlparse(resource.service.base_url).netloc
@@ -175,18 +616,25 @@ def prepare_source_host(resource):
         return None
 
 
+@timed
 def prepare_title(resource):
     return resource.title
 
 
+@timed
 def prepare_references(resource):
+    # ows_links is set when the links were prefetched for a chunk
+    links = getattr(resource, 'ows_links', None)
+    if links is None:
+        links = resource.link_set.ows()
     return [{
         'name': link.name,
         'scheme': link.link_type,
         'url': link.url
-    } for link in resource.link_set.ows()]
+    } for link in links]
 
 
+@timed
 def prepare_subtype(resource):
     if resource.storeType == "dataStore":
         return "vector"
@@ -200,6 +648,7 @@ def prepare_subtype(resource):
 
 # Check to see if either time extent is set on the object,
 # if so, then it is time enabled.
+@timed
 def prepare_has_time(resource):
     try:
         # if either time field is set to a value then time is enabled.
@@ -211,6 +660,25 @@ def prepare_has_time(resource):
         return False
 
 
+def apply_prefetch_plan(queryset, index):
+    '''
+    Loads the relations an index type needs up front, so a chunk of
+    objects costs a constant number of queries instead of several per object.
+    :param queryset: The queryset of objects to index
+    :param index: The search index the objects are put in
+    :return: The queryset with select_related and prefetch_related applied
+    '''
+    prefetch_plan = getattr(index, 'prefetch_plan', None)
+    if prefetch_plan is None:
+        return queryset
+    plan = prefetch_plan()
+    if plan.get('select_related'):
+        queryset = queryset.select_related(*plan['select_related'])
+    if plan.get('prefetch_related'):
+        queryset = queryset.prefetch_related(*plan['prefetch_related'])
+    return queryset
+
+
 class LayerIndex(DocType):
     id = Integer()
     abstract = Text(
@@ -305,12 +773,36 @@ class LayerIndex(DocType):
     num_comments = Integer()
     geogig_link = Keyword()
     has_time = Boolean()
+    # Who may view the resource, see prepare_read_permissions
+    read_users = Keyword()
+    read_groups = Keyword()
+    public = Boolean()
+    content_hash = Keyword(index=False)
+
+    @classmethod
+    def prefetch_plan(cls):
+        return {
+            'select_related': (
+                'owner',
+                'category',
+                'service',
+                'service__category'
+            ),
+            'prefetch_related': (
+                'keywords',
+                'regions',
+                Prefetch('link_set', queryset=Link.objects.ows(),
+                         to_attr='ows_links')
+            )
+        }
 
     class Meta:
         index = 'layer-index'
 
 
-def create_layer_index(layer):
+def create_layer_index(layer, save=True, prepared=None):
+    permissions = prepared_value(prepared, 'permissions',
+                                 prepare_permissions, layer)
     obj = LayerIndex(
         meta={'id': layer.id},
         id=layer.id,
@@ -326,7 +818,7 @@ def create_layer_index(layer):
         featured=layer.featured,
         popular_count=layer.popular_count,
         share_count=layer.share_count,
-        rating=prepare_rating(layer),
+        rating=prepared_value(prepared, 'rating', prepare_rating, layer),
         srid=layer.srid,
         supplemental_information=prepare_supplemental_information(layer),
         thumbnail_url=layer.thumbnail_url,
@@ -338,26 +830,32 @@ def create_layer_index(layer):
         typename=layer.service_typename,
         title_sortable=prepare_title_sortable(layer),
         category=prepare_category(layer),
-        bbox=prepare_bbox(layer),
+        bbox=prepared_value(prepared, 'bbox', prepare_bbox, layer),
         temporal_extent_start=layer.temporal_extent_start,
         temporal_extent_end=layer.temporal_extent_end,
         keywords=layer.keyword_slug_list(),
         regions=layer.region_name_list(),
-        num_ratings=prepare_num_ratings(layer),
-        num_comments=prepare_num_comments(layer),
+        num_ratings=prepared_value(prepared, 'num_ratings', prepare_num_ratings, layer),
+        num_comments=prepared_value(prepared, 'num_comments', prepare_num_comments, layer),
         geogig_link=layer.geogig_link,
         has_time=prepare_has_time(layer),
         references=prepare_references(layer),
-        source_host=prepare_source_host(layer)
+        source_host=prepare_source_host(layer),
+        read_users=permissions['read_users'],
+        read_groups=permissions['read_groups'],
+        public=permissions['public']
     )
-    try:
-        obj.save()
-    except TransportError as e:
-        error_msg = 'Error indexing layer: {0} [id: {1}]; bbox: {2}'.format(
-            obj.title, obj.id, obj.bbox
-        )
-        logger.error(error_msg)
-        logger.error(e.info)
+    obj.content_hash = document_hash(obj)
+    if save:
+        try:
+            obj.save()
+        except TransportError as e:
+            error_msg = 'Error indexing layer: {0} [id: {1}]; bbox: {2}'.format(
+                obj.title, obj.id, obj.bbox
+            )
+            logger.error(error_msg)
+            logger.error(e.info)
+            dead_letters.record(obj._doc_type.index, obj.meta.id, e.info)
     return obj.to_dict(include_meta=True)
 
 
@@ -422,12 +920,26 @@ class MapIndex(DocType):
     )
     num_ratings = Integer()
     num_comments = Integer()
+    # Who may view the resource, see prepare_read_permissions
+    read_users = Keyword()
+    read_groups = Keyword()
+    public = Boolean()
+    content_hash = Keyword(index=False)
+
+    @classmethod
+    def prefetch_plan(cls):
+        return {
+            'select_related': ('owner', 'category'),
+            'prefetch_related': ('keywords', 'regions')
+        }
 
     class Meta:
         index = 'map-index'
 
 
-def create_map_index(map):
+def create_map_index(map, save=True, prepared=None):
+    permissions = prepared_value(prepared, 'permissions',
+                                 prepare_permissions, map)
     obj = MapIndex(
         meta={'id': map.id},
         id=map.id,
@@ -439,7 +951,7 @@ def create_map_index(map):
         owner__username=prepare_owner(map),
         popular_count=map.popular_count,
         share_count=map.share_count,
-        rating=prepare_rating(map),
+        rating=prepared_value(prepared, 'rating', prepare_rating, map),
         srid=map.srid,
         supplemental_information=prepare_supplemental_information(map),
         thumbnail_url=map.thumbnail_url,
@@ -449,22 +961,28 @@ def create_map_index(map):
         type='map',
         title_sortable=prepare_title_sortable(map),
         category=prepare_category(map),
-        bbox=prepare_bbox(map),
+        bbox=prepared_value(prepared, 'bbox', prepare_bbox, map),
         temporal_extent_start=map.temporal_extent_start,
         temporal_extent_end=map.temporal_extent_end,
         keywords=map.keyword_slug_list(),
         regions=map.region_name_list(),
-        num_ratings=prepare_num_ratings(map),
-        num_comments=prepare_num_comments(map),
+        num_ratings=prepared_value(prepared, 'num_ratings', prepare_num_ratings, map),
+        num_comments=prepared_value(prepared, 'num_comments', prepare_num_comments, map),
+        read_users=permissions['read_users'],
+        read_groups=permissions['read_groups'],
+        public=permissions['public']
     )
-    try:
-        obj.save()
-    except TransportError as e:
-        error_msg = 'Error indexing map: {0} [id: {1}]; bbox: {2}'.format(
-            obj.title, obj.id, obj.bbox
-        )
-        logger.error(error_msg)
-        logger.error(e.info)
+    obj.content_hash = document_hash(obj)
+    if save:
+        try:
+            obj.save()
+        except TransportError as e:
+            error_msg = 'Error indexing map: {0} [id: {1}]; bbox: {2}'.format(
+                obj.title, obj.id, obj.bbox
+            )
+            logger.error(error_msg)
+            logger.error(e.info)
+            dead_letters.record(obj._doc_type.index, obj.meta.id, e.info)
     return obj.to_dict(include_meta=True)
 
 
@@ -529,12 +1047,26 @@ class DocumentIndex(DocType):
     )
     num_ratings = Integer()
     num_comments = Integer()
+    # Who may view the resource, see prepare_read_permissions
+    read_users = Keyword()
+    read_groups = Keyword()
+    public = Boolean()
+    content_hash = Keyword(index=False)
+
+    @classmethod
+    def prefetch_plan(cls):
+        return {
+            'select_related': ('owner', 'category'),
+            'prefetch_related': ('keywords', 'regions')
+        }
 
     class Meta:
         index = 'document-index'
 
 
-def create_document_index(document):
+def create_document_index(document, save=True, prepared=None):
+    permissions = prepared_value(prepared, 'permissions',
+                                 prepare_permissions, document)
     obj = DocumentIndex(
         meta={'id': document.id},
         id=document.id,
@@ -546,7 +1078,7 @@ def create_document_index(document):
         owner__username=prepare_owner(document),
         popular_count=document.popular_count,
         share_count=document.share_count,
-        rating=prepare_rating(document),
+        rating=prepared_value(prepared, 'rating', prepare_rating, document),
         srid=document.srid,
         supplemental_information=prepare_supplemental_information(document),
         thumbnail_url=document.thumbnail_url,
@@ -556,22 +1088,28 @@ def create_document_index(document):
         type="document",
         title_sortable=document.title.lower(),
         category=prepare_category(document),
-        bbox=prepare_bbox(document),
+        bbox=prepared_value(prepared, 'bbox', prepare_bbox, document),
         temporal_extent_start=document.temporal_extent_start,
         temporal_extent_end=document.temporal_extent_end,
         keywords=document.keyword_slug_list(),
         regions=document.region_name_list(),
-        num_ratings=prepare_num_ratings(document),
-        num_comments=prepare_num_comments(document),
+        num_ratings=prepared_value(prepared, 'num_ratings', prepare_num_ratings, document),
+        num_comments=prepared_value(prepared, 'num_comments', prepare_num_comments, document),
+        read_users=permissions['read_users'],
+        read_groups=permissions['read_groups'],
+        public=permissions['public']
     )
-    try:
-        obj.save()
-    except TransportError as e:
-        error_msg = 'Error indexing document: {0} [id: {1}]; bbox: {2}'.format(
-            obj.title, obj.id, obj.bbox
-        )
-        logger.error(error_msg)
-        logger.error(e.info)
+    obj.content_hash = document_hash(obj)
+    if save:
+        try:
+            obj.save()
+        except TransportError as e:
+            error_msg = 'Error indexing document: {0} [id: {1}]; bbox: {2}'.format(
+                obj.title, obj.id, obj.bbox
+            )
+            logger.error(error_msg)
+            logger.error(e.info)
+            dead_letters.record(obj._doc_type.index, obj.meta.id, e.info)
     return obj.to_dict(include_meta=True)
 
 
@@ -600,27 +1138,16 @@ class ProfileIndex(DocType):
     documents_count = Integer()
     profile_detail_url = Text()
     date_joined = Date()
+    content_hash = Keyword(index=False)
 
     class Meta:
         index = 'profile-index'
 
 
-def create_profile_index(profile):
+def create_profile_index(profile, save=True, prepared=None):
     # calculate counts and avatar
-    layers_count = get_objects_for_user(
-        profile,
-        'base.view_resourcebase'
-    ).instance_of(Layer).count()
-
-    maps_count = get_objects_for_user(
-        profile,
-        'base.view_resourcebase'
-    ).instance_of(Map).count()
-
-    documents_count = get_objects_for_user(
-        profile,
-        'base.view_resourcebase'
-    ).instance_of(Document).count()
+    if prepared is None:
+        prepared = prepare_visible_counts(profile)
 
     avatar_100 = avatar_url(profile, 240)
 
@@ -635,15 +1162,17 @@ def create_profile_index(profile):
         position=profile.position,
         type='user',
         avatar_100=avatar_100,
-        layers_count=layers_count,
-        maps_count=maps_count,
-        documents_count=documents_count,
+        layers_count=prepared['layers_count'],
+        maps_count=prepared['maps_count'],
+        documents_count=prepared['documents_count'],
         profile_detail_url="/people/profile/{username}/".format(
             username=profile.username
         ),
         date_joined=profile.date_joined
     )
-    obj.save()
+    obj.content_hash = document_hash(obj)
+    if save:
+        obj.save()
     return obj.to_dict(include_meta=True)
 
 
@@ -667,12 +1196,13 @@ class GroupIndex(DocType):
     )
     detail_url = Text()
     last_modified = Date()
+    content_hash = Keyword(index=False)
 
     class Meta:
         index = 'group-index'
 
 
-def create_group_index(group):
+def create_group_index(group, save=True):
     obj = GroupIndex(
         meta={'id': group.id},
         id=group.id,
@@ -686,5 +1216,83 @@ def create_group_index(group):
         ),
         last_modified=group.last_modified
     )
-    obj.save()
+    obj.content_hash = document_hash(obj)
+    if save:
+        obj.save()
+    return obj.to_dict(include_meta=True)
+
+
+class PermissionIndex(DocType):
+    '''
+    The uuids of the resources a user or group can view, one document
+    per user or group, for filtering searches with a terms lookup
+    '''
+    principal = Keyword()
+    resources = Keyword(index=False)
+
+    class Meta:
+        index = 'permission-index'
+
+
+def permission_document_id(kind, pk):
+    '''
+    :param kind: 'user' or 'group'
+    :param pk: The primary key of the user or group
+    '''
+    return '{0}-{1}'.format(kind, pk)
+
+
+def create_permission_index(kind, pk, save=True):
+    '''
+    Lists the uuids of the resources a user or group has the
+    view_resourcebase object permission on. A user's groups have
+    documents of their own.
+    :param kind: 'user' or 'group'
+    :param pk: The primary key of the user or group
+    '''
+    if kind == 'user':
+        permissions = UserObjectPermission.objects.filter(user=pk)
+    else:
+        permissions = GroupObjectPermission.objects.filter(group=pk)
+    object_pks = sorted(set(int(object_pk) for object_pk in permissions.filter(
+        permission=view_permission()
+    ).values_list('object_pk', flat=True)))
+    uuids = []
+    for i in range(0, len(object_pks), 1000):
+        uuids.extend(ResourceBase.objects.filter(
+            pk__in=object_pks[i:i + 1000]
+        ).values_list('uuid', flat=True))
+
+    principal = permission_document_id(kind, pk)
+    obj = PermissionIndex(
+        meta={'id': principal},
+        principal=principal,
+        resources=sorted(uuids)
+    )
+    if save:
+        obj.save()
     return obj.to_dict(include_meta=True)
+
+
+class IndexStateIndex(DocType):
+    '''
+    Bookkeeping for the indexing commands, one document per index
+    '''
+    name = Keyword()
+    watermark = Date()
+    # The last primary key sent by an unfinished update_index run,
+    # with the index it wrote to and the times it was started with
+    checkpoint = Integer()
+    checkpoint_index = Keyword()
+    checkpoint_since = Date()
+    checkpoint_started = Date()
+
+    class Meta:
+        index = 'index-state'
+
+
+def get_index_state(index_name):
+    state = IndexStateIndex.get(id=index_name, ignore=404)
+    if state is None:
+        state = IndexStateIndex(meta={'id': index_name}, name=index_name)
+    return state
@@ -1,6 +1,18 @@
-from django.db.models.signals import post_save, post_delete
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import m2m_changed, post_save, post_delete
 from django.dispatch import receiver
-from elasticsearch_app.utils import index_object
+from elasticsearch_app.permissions import (
+    invalidate_permissions,
+    permissions_cached
+)
+from elasticsearch_app.utils import (
+    index_permissions,
+    index_resource,
+    index_service_layers
+)
+from elasticsearch_app.writer import queue_call, queue_delete, queue_index
 
 geonode_imported = True
 try:
@@ -10,6 +22,8 @@ try:
     from geonode.people.models import Profile
     from geonode.groups.models import GroupProfile
     from geonode.services.models import Service
+    from geonode.base.models import ResourceBase
+    from guardian.models import GroupObjectPermission, UserObjectPermission
     from elasticsearch_app.search import (
         LayerIndex,
         MapIndex,
@@ -26,72 +40,93 @@ except ImportError:
 # project here
 
 if geonode_imported:
+    # Indexing is queued to a background writer, so saves don't
+    # wait for elasticsearch. See elasticsearch_app.writer
     @receiver(post_save, sender=Layer)
     def layer_index_post(sender, instance, **kwargs):
-        index_object(instance, LayerIndex)
-        index_object(instance.owner, ProfileIndex)
+        queue_index(instance, LayerIndex)
+        queue_index(instance.owner, ProfileIndex)
 
     @receiver(post_save, sender=Service)
     def service_post_save(sender, **kwargs):
         service, created = kwargs["instance"], kwargs["created"]
         if not created:
-            for instance in service.layer_set.all():
-                index_object(instance, LayerIndex)
-                index_object(instance.owner, ProfileIndex)
+            queue_call(('service', service.pk), index_service_layers, service)
 
     @receiver(post_delete, sender=Layer)
     def layer_index_delete(sender, instance, **kwargs):
-        index_to_remove = LayerIndex.get(instance.id)
-        if index_to_remove:
-            index_to_remove.delete()
-        index_object(instance.owner, ProfileIndex)
+        queue_delete(instance, LayerIndex)
+        queue_index(instance.owner, ProfileIndex)
 
     @receiver(post_save, sender=Map)
     def map_index_post(sender, instance, **kwargs):
-        index_object(instance, MapIndex)
-        index_object(instance.owner, ProfileIndex)
+        queue_index(instance, MapIndex)
+        queue_index(instance.owner, ProfileIndex)
 
     @receiver(post_delete, sender=Map)
     def map_index_delete(sender, instance, **kwargs):
-        index_to_remove = MapIndex.get(instance.id)
-        if index_to_remove:
-            index_to_remove.delete()
-        index_object(instance.owner, ProfileIndex)
+        queue_delete(instance, MapIndex)
+        queue_index(instance.owner, ProfileIndex)
 
     @receiver(post_save, sender=Document)
     def document_index_post(sender, instance, **kwargs):
-        index_object(instance, DocumentIndex)
-        index_object(instance.owner, ProfileIndex)
+        queue_index(instance, DocumentIndex)
+        queue_index(instance.owner, ProfileIndex)
 
     @receiver(post_delete, sender=Document)
     def document_index_delete(sender, instance, **kwargs):
-        index_to_remove = DocumentIndex.get(instance.id)
-        if index_to_remove:
-            index_to_remove.delete()
-        index_object(instance.owner, ProfileIndex)
+        queue_delete(instance, DocumentIndex)
+        queue_index(instance.owner, ProfileIndex)
 
     @receiver(post_save, sender=Profile)
     def profile_index_post(sender, instance, **kwargs):
-        index_object(instance, ProfileIndex)
+        queue_index(instance, ProfileIndex)
 
     @receiver(post_delete, sender=Profile)
     def profile_index_delete(sender, instance, **kwargs):
-        index_to_remove = ProfileIndex.get(instance.id)
-        if index_to_remove:
-            index_to_remove.delete()
+        queue_delete(instance, ProfileIndex)
 
     @receiver(post_save, sender=GroupProfile)
     def group_index_post(sender, instance, **kwargs):
-        index_object(instance, GroupIndex)
+        queue_index(instance, GroupIndex)
 
     @receiver(post_delete, sender=GroupProfile)
     def group_index_delete(sender, instance, **kwargs):
-        try:
-            index_to_remove = GroupIndex.get(instance.id)
-            if index_to_remove:
-                index_to_remove.delete()
-        except:
-            pass
+        queue_delete(instance, GroupIndex)
+
+    # The resources a user may view are cached for searches,
+    # see elasticsearch_app.permissions
+    @receiver(post_save, sender=UserObjectPermission)
+    @receiver(post_delete, sender=UserObjectPermission)
+    @receiver(post_save, sender=GroupObjectPermission)
+    @receiver(post_delete, sender=GroupObjectPermission)
+    def object_permission_changed(sender, instance, **kwargs):
+        if permissions_cached():
+            invalidate_permissions()
+        # The documents list who may view them
+        resource_type = ContentType.objects.get_for_model(ResourceBase)
+        if instance.content_type_id == resource_type.id:
+            resource_id = int(instance.object_pk)
+            queue_call(('permissions', resource_id), index_resource, resource_id)
+            if getattr(settings, 'ES_PERMISSION_FILTER', 'acl') == 'lookup':
+                if sender is UserObjectPermission:
+                    kind, pk = 'user', instance.user_id
+                else:
+                    kind, pk = 'group', instance.group_id
+                queue_call(('permission-index', kind, pk),
+                           index_permissions, kind, pk)
+
+    @receiver(m2m_changed, sender=get_user_model().groups.through)
+    def user_groups_changed(sender, **kwargs):
+        if permissions_cached():
+            invalidate_permissions()
+
+    @receiver(post_save)
+    @receiver(post_delete)
+    def resource_changed(sender, instance, **kwargs):
+        # Any resource type, publishing can change who may view it
+        if permissions_cached() and isinstance(instance, ResourceBase):
+            invalidate_permissions()
 
 # To extend this app in your project, add a post_save
 # signal for every model you wish to index.
@@ -102,4 +137,4 @@ if geonode_imported:
 #
 # @receiver(post_save, sender=<Model>)
 # def <Model>_index_post(sender, instance, **kwargs):
-#     index_object(instance)
+#     queue_index(instance, <Model>Index)
@@ -0,0 +1,125 @@
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.db import connection
+
+# The Timings collecting in this process, None when stats are off
+current = None
+
+
+class Timings(object):
+    '''
+    Cumulative calls and seconds per stage of the indexing
+    pipeline, and the number of database queries.
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.queries = 0
+
+    def add(self, name, seconds, calls=1):
+        stage_calls, stage_seconds = self.stages.get(name, (0, 0.0))
+        self.stages[name] = (stage_calls + calls, stage_seconds + seconds)
+
+    def count_queries(self):
+        # The query log is bounded, so it is drained regularly
+        self.queries += len(connection.queries_log)
+        connection.queries_log.clear()
+
+    def merge(self, data):
+        self.queries += data['queries']
+        for name, (calls, seconds) in data['stages'].items():
+            self.add(name, seconds, calls)
+
+    def to_dict(self):
+        return {'queries': self.queries, 'stages': dict(self.stages)}
+
+
+def start():
+    '''
+    Starts collecting timings in this process
+    '''
+    global current
+    current = Timings()
+    connection.force_debug_cursor = True
+    connection.queries_log.clear()
+    return current
+
+
+def stop():
+    '''
+    Stops collecting timings
+    :return: The collected Timings
+    '''
+    global current
+    timings = current
+    current = None
+    if timings is not None:
+        timings.count_queries()
+    connection.force_debug_cursor = False
+    return timings
+
+
+@contextmanager
+def timer(name):
+    if current is None:
+        yield
+        return
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        if current is not None:
+            current.add(name, time.time() - start_time)
+
+
+def timed(func):
+    '''
+    Records the cumulative time of a function while stats are collected
+    '''
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if current is None:
+            return func(*args, **kwargs)
+        with timer(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def count_queries():
+    if current is not None:
+        current.count_queries()
+
+
+def instrument_client(es):
+    '''
+    Times JSON serialization and bulk requests of an elasticsearch client
+    '''
+    if getattr(es, 'instrumented', False):
+        return es
+    serializer = es.transport.serializer
+    es.transport.serializer = TimedSerializer(serializer)
+    bulk = es.bulk
+
+    @wraps(bulk)
+    def timed_bulk(*args, **kwargs):
+        with timer('bulk_request'):
+            return bulk(*args, **kwargs)
+    es.bulk = timed_bulk
+    es.instrumented = True
+    return es
+
+
+class TimedSerializer(object):
+    def __init__(self, serializer):
+        self.serializer = serializer
+        self.mimetype = serializer.mimetype
+
+    def dumps(self, data):
+        with timer('serialize'):
+            return self.serializer.dumps(data)
+
+    def loads(self, s):
+        return self.serializer.loads(s)
@@ -0,0 +1,214 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from elasticsearch_dsl import Search
+from geonode.base.models import ResourceBase
+from geonode.base.populate_test_data import create_models
+from geonode.layers.models import Layer
+from geonode.utils import bbox_to_projection
+from guardian.models import GroupObjectPermission, UserObjectPermission
+from guardian.shortcuts import assign_perm, get_objects_for_user
+from guardian.utils import get_anonymous_user
+
+from elasticsearch_app.search import (
+    LayerIndex,
+    bbox_to_geoshape,
+    prepare_bboxes,
+    prepare_profile_counts,
+    prepare_read_permissions,
+    prepare_visible_counts,
+    view_permission
+)
+from elasticsearch_app.utils import index_action_chunks
+from elasticsearch_app.views import apply_base_filter
+
+VIEW = 'base.view_resourcebase'
+
+
+class IndexActionChunksTest(TestCase):
+    def setUp(self):
+        create_models(type='layer')
+
+    def build(self, queryset):
+        return [action for last_pk, actions
+                in index_action_chunks(queryset, LayerIndex)
+                for action in actions]
+
+    def test_queries_dont_grow_with_layers(self):
+        layers = Layer.objects.all()
+        self.assertGreater(layers.count(), 1)
+        # Warms up what is cached between runs, such as the view permission
+        self.build(layers)
+        one_layer = layers.filter(pk=layers.first().pk)
+
+        with CaptureQueriesContext(connection) as queries:
+            actions = self.build(one_layer)
+        self.assertEqual(len(actions), 1)
+
+        with self.assertNumQueries(len(queries)):
+            actions = self.build(layers)
+        self.assertEqual(len(actions), layers.count())
+
+
+class BboxResource(object):
+    # Stands in for a resource, prepare_bboxes only reads these
+    def __init__(self, pk, bbox, srid):
+        self.pk = pk
+        self.bbox = list(bbox) + [srid]
+        self.srid = srid
+
+
+class PrepareBboxesTest(SimpleTestCase):
+    def test_matches_bbox_to_projection(self):
+        # GeoNode bboxes are [x0, x1, y0, y1]
+        bbox = [-8238310.24, -8233569.93, 4966705.91, 4971446.22]
+        expected = bbox_to_geoshape(bbox_to_projection(
+            bbox, source_srid='EPSG:3857', target_srid=4326
+        )[:4])
+        self.assertIsNotNone(expected)
+
+        prepared = prepare_bboxes([BboxResource(1, bbox, 'EPSG:3857')])[1]
+        self.assertEqual(prepared['type'], expected['type'])
+        for corner, expected_corner in zip(prepared['coordinates'],
+                                           expected['coordinates']):
+            for value, expected_value in zip(corner, expected_corner):
+                self.assertAlmostEqual(value, expected_value, places=6)
+
+
+class PermissionsTestCase(TestCase):
+    '''
+    Layers whose view permission is only granted as each test sets it up
+    '''
+    def setUp(self):
+        create_models(type='layer')
+        perm = view_permission()
+        UserObjectPermission.objects.filter(permission=perm).delete()
+        GroupObjectPermission.objects.filter(permission=perm).delete()
+        self.layers = list(Layer.objects.order_by('pk'))
+        self.assertGreaterEqual(len(self.layers), 4)
+        User = get_user_model()
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'x')
+        self.group = Group.objects.create(name='readers')
+        self.user.groups.add(self.group)
+        self.anonymous_group, created = Group.objects.get_or_create(
+            name='anonymous'
+        )
+
+    def get_user(self, user):
+        # Fresh, without cached permissions
+        return get_user_model().objects.get(pk=user.pk)
+
+    def resource(self, layer):
+        return ResourceBase.objects.get(pk=layer.pk)
+
+    def prepared(self):
+        return prepare_read_permissions([layer.pk for layer in self.layers])
+
+
+def acl_visible(user, prepared):
+    # What the 'acl' filter of apply_base_filter matches
+    user_id = str(user.pk)
+    group_ids = set(str(i) for i in user.groups.values_list('id', flat=True))
+    return set(pk for pk, permissions in prepared.items()
+               if permissions['public'] or
+               user_id in permissions['read_users'] or
+               group_ids.intersection(permissions['read_groups']))
+
+
+@override_settings(SKIP_PERMS_FILTER=False, ES_PERMISSION_FILTER='acl')
+class ReadPermissionsTest(PermissionsTestCase):
+    def base_filter(self, user):
+        request = RequestFactory().get('/')
+        request.user = user
+        return apply_base_filter(request, Search()).to_dict()
+
+    def test_public_from_anonymous_user(self):
+        public, private = self.layers[:2]
+        assign_perm(VIEW, get_anonymous_user(), self.resource(public))
+        prepared = self.prepared()
+        self.assertTrue(prepared[public.pk]['public'])
+        self.assertFalse(prepared[private.pk]['public'])
+
+    def test_public_from_anonymous_group(self):
+        public, private = self.layers[:2]
+        assign_perm(VIEW, self.anonymous_group, self.resource(public))
+        prepared = self.prepared()
+        self.assertTrue(prepared[public.pk]['public'])
+        self.assertEqual(prepared[public.pk]['read_groups'],
+                         [str(self.anonymous_group.pk)])
+        self.assertFalse(prepared[private.pk]['public'])
+
+    def test_group_only_grant(self):
+        shared = self.layers[0]
+        assign_perm(VIEW, self.group, self.resource(shared))
+        prepared = self.prepared()
+        self.assertEqual(prepared[shared.pk], {
+            'read_users': [],
+            'read_groups': [str(self.group.pk)],
+            'public': False
+        })
+        self.assertEqual(acl_visible(self.user, prepared), set([shared.pk]))
+        self.assertIn(
+            json.dumps({'terms': {'read_groups': [str(self.group.pk)]}}),
+            json.dumps(self.base_filter(self.get_user(self.user)))
+        )
+
+    def test_global_permission_is_not_filtered(self):
+        self.user.user_permissions.add(view_permission())
+        self.assertEqual(self.base_filter(self.get_user(self.user)),
+                         Search().to_dict())
+        superuser = get_user_model().objects.create_superuser(
+            'root', 'root@example.com', 'x'
+        )
+        self.assertEqual(self.base_filter(superuser), Search().to_dict())
+
+    def test_matches_get_objects_for_user(self):
+        # GeoNode adds every user to the anonymous group
+        self.user.groups.add(self.anonymous_group)
+        own, shared, public = self.layers[:3]
+        assign_perm(VIEW, self.user, self.resource(own))
+        assign_perm(VIEW, self.group, self.resource(shared))
+        assign_perm(VIEW, self.anonymous_group, self.resource(public))
+        user = self.get_user(self.user)
+        expected = set(get_objects_for_user(user, VIEW).filter(
+            pk__in=[layer.pk for layer in self.layers]
+        ).values_list('pk', flat=True))
+        self.assertEqual(expected, set([own.pk, shared.pk, public.pk]))
+        self.assertEqual(acl_visible(user, self.prepared()), expected)
+        query = json.dumps(self.base_filter(user))
+        self.assertIn(json.dumps({'term': {'read_users': str(user.pk)}}),
+                      query)
+        self.assertIn(json.dumps({'term': {'public': True}}), query)
+
+
+class ProfileCountsTest(PermissionsTestCase):
+    def test_matches_get_objects_for_user(self):
+        User = get_user_model()
+        superuser = User.objects.create_superuser(
+            'root', 'root@example.com', 'x'
+        )
+        global_user = User.objects.create_user(
+            'global', 'global@example.com', 'x'
+        )
+        global_user.user_permissions.add(view_permission())
+        # self.user only views through its group
+        assign_perm(VIEW, self.group, self.resource(self.layers[0]))
+        inactive = User.objects.create_user(
+            'inactive', 'inactive@example.com', 'x'
+        )
+        inactive.is_active = False
+        inactive.save()
+        inactive.user_permissions.add(view_permission())
+        assign_perm(VIEW, inactive, self.resource(self.layers[1]))
+
+        profiles = [self.get_user(user) for user in
+                    (superuser, global_user, self.user, inactive)]
+        prepared = prepare_profile_counts(profiles)
+        for profile in profiles:
+            self.assertEqual(prepared[profile.pk],
+                             prepare_visible_counts(self.get_user(profile)),
+                             profile.username)
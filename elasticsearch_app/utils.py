@@ -1,13 +1,47 @@
-from elasticsearch_app import search
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
 
+from django.conf import settings
+from django.core.cache import cache
+from elasticsearch import TransportError
+from elasticsearch.helpers import expand_action, scan
+from elasticsearch_dsl import connections
+from six.moves.queue import Queue
+from elasticsearch_app import dead_letters, search, stats
+from geonode.people.models import Profile
+from geonode.groups.models import GroupProfile
 
-def index_object(object, index=None):
+# The models this app indexes with their search index.
+# Any indices added in search.py should be added here.
+INDEXED_MODELS = (
+    (search.Layer, search.LayerIndex),
+    (search.Map, search.MapIndex),
+    (search.Document, search.DocumentIndex),
+    (Profile, search.ProfileIndex),
+    (GroupProfile, search.GroupIndex)
+)
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# Key of the cached list of indices searched
+SEARCHABLE_INDICES_KEY = 'elasticsearch_app:searchable_indices'
+
+
+def index_object(object, index=None, save=True, prepared=None):
     '''
     Indexes an object into its appropriate model index.
     Tries to use its indexing method if it exists.
     Otherwise, it will index it with just the id.
     :param object: The object you wish to index
     :param index: The search index to put the object in
+    :param save: If False, only build the document without sending it
+        to elasticsearch. The returned dict can be used as a bulk action.
+    :param prepared: Values already prepared for this object in a batch,
+        see search.prepare_chunk
     :return: A dict of the successfully indexed object
     '''
     try:
@@ -22,17 +56,21 @@ def index_object(object, index=None):
             classname = object.class_name
 
     if classname == 'Profile':
-        return search.create_profile_index(object)
+        return search.create_profile_index(object, save=save,
+                                           prepared=prepared)
     elif classname == 'Group':
-        return search.create_group_index(object)
+        return search.create_group_index(object, save=save)
     elif classname == 'GroupProfile':
-        return search.create_group_index(object)
+        return search.create_group_index(object, save=save)
     elif classname == 'Document':
-        return search.create_document_index(object)
+        return search.create_document_index(object, save=save,
+                                            prepared=prepared)
     elif classname == 'Layer':
-        return search.create_layer_index(object)
+        return search.create_layer_index(object, save=save,
+                                         prepared=prepared)
     elif classname == 'Map':
-        return search.create_map_index(object)
+        return search.create_map_index(object, save=save,
+                                       prepared=prepared)
     elif hasattr(object, 'indexing'):
         return object.indexing()
     else:
@@ -41,5 +79,761 @@ def index_object(object, index=None):
                 meta={'id': object.id},
                 id=object.id
             )
-            indexed_object.save()
-            return index_object.to_dict(include_meta=True)
+            if save:
+                indexed_object.save()
+            return indexed_object.to_dict(include_meta=True)
+
+
+def index_resource(resource_id):
+    '''
+    Re-indexes a layer, map or document by its ResourceBase id. The
+    document is also written to a generation rebuild_index is filling,
+    see generation_actions.
+    :param resource_id: The primary key of the resource
+    '''
+    resource = search.ResourceBase.objects.filter(pk=resource_id).first()
+    if resource is None:
+        return
+    resource = resource.get_real_instance()
+    for model, doctype in INDEXED_MODELS:
+        if isinstance(resource, model):
+            try:
+                action = index_object(resource, doctype, save=False)
+            except Exception as e:
+                dead_letters.record(doctype._doc_type.index, resource.pk,
+                                    str(e))
+                raise
+            es = connections.get_connection()
+            indexed, errors = send_bulk(es, generation_actions(es, [action]),
+                                        thread_count=1)
+            for error in errors:
+                logger.error('Error indexing: {}'.format(error))
+            return action
+
+
+def index_permissions(kind, pk):
+    '''
+    Re-indexes the permission document of a user or group,
+    see search.PermissionIndex. A failure is recorded as a dead letter,
+    a stale document would keep showing resources whose access was revoked.
+    :param kind: 'user' or 'group'
+    :param pk: The primary key of the user or group
+    '''
+    try:
+        return search.create_permission_index(kind, pk)
+    except Exception as e:
+        dead_letters.record(search.PermissionIndex._doc_type.index,
+                            search.permission_document_id(kind, pk), str(e))
+        raise
+
+
+def permission_actions():
+    '''
+    Builds the permission document of every user and group with a
+    view_resourcebase object permission
+    :return: A generator of bulk action dicts
+    '''
+    perm = search.view_permission()
+    for kind, model in (('user', search.UserObjectPermission),
+                        ('group', search.GroupObjectPermission)):
+        pks = model.objects.filter(permission=perm).order_by(kind).values_list(
+            kind, flat=True).distinct()
+        for pk in pks:
+            yield search.create_permission_index(kind, pk, save=False)
+
+
+def update_permission_index(es):
+    '''
+    Rebuilds the permission document of every user and group with a
+    view_resourcebase object permission, and deletes the documents of
+    the others, whose last permission was revoked.
+    :param es: The elasticsearch client
+    :return: A tuple of the number of documents indexed, the number
+        removed and the list of bulk error items
+    '''
+    index = search.PermissionIndex._doc_type.index
+    principals = set()
+
+    def actions():
+        for action in permission_actions():
+            principals.add(action['_id'])
+            yield action
+
+    indexed, errors = send_bulk(es, actions())
+    hits = scan(es, index=index, query={'_source': False})
+    stale = sorted(hit['_id'] for hit in hits if hit['_id'] not in principals)
+    removed, remove_errors = send_bulk(es, ({
+        '_op_type': 'delete',
+        '_index': index,
+        '_type': search.PermissionIndex._doc_type.name,
+        '_id': principal
+    } for principal in stale))
+    return indexed, removed, errors + remove_errors
+
+
+def queryset_chunks(queryset, chunk_size=500):
+    '''
+    Iterates over a queryset in lists of chunk_size objects,
+    ordered by primary key.
+    :param queryset: The queryset to iterate over
+    :param chunk_size: The number of objects loaded per query
+    :return: A generator of lists of objects
+    '''
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk_queryset = queryset
+        if last_pk is not None:
+            chunk_queryset = queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk_queryset[:chunk_size])
+        if not chunk:
+            break
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def index_action_chunks(queryset, index=None, chunk_size=500):
+    '''
+    Builds bulk actions for every object in a queryset without
+    sending anything to elasticsearch. Relations are loaded with the
+    index's prefetch plan and expensive columns are prepared for a whole
+    chunk of objects at once.
+    :param queryset: The queryset of objects to index
+    :param index: The search index to put the objects in
+    :param chunk_size: The number of objects prepared together
+    :return: A generator of (last primary key, list of bulk action dicts)
+        pairs, one per chunk in primary key order
+    '''
+    queryset = search.apply_prefetch_plan(queryset, index)
+    chunks = queryset_chunks(queryset, chunk_size)
+    while True:
+        with stats.timer('load_chunk'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        prepared = search.prepare_chunk(queryset.model, chunk)
+        with stats.timer('build_documents'):
+            actions = [index_object(object, index, save=False,
+                                    prepared=prepared.get(object.pk))
+                       for object in chunk]
+        stats.count_queries()
+        yield chunk[-1].pk, actions
+
+
+def index_actions(queryset, index=None, chunk_size=500):
+    '''
+    Builds bulk actions for every object in a queryset,
+    see index_action_chunks.
+    :return: A generator of bulk action dicts
+    '''
+    for last_pk, actions in index_action_chunks(queryset, index, chunk_size):
+        for action in actions:
+            yield action
+
+
+def skip_unchanged(es, actions, chunk_size=500):
+    '''
+    Filters out the bulk actions whose document is already indexed with
+    the same content hash. The indexed hashes are fetched with one mget
+    per chunk of actions.
+    :param es: The elasticsearch client
+    :param actions: An iterable of bulk action dicts
+    :param chunk_size: The number of documents looked up together
+    :return: A generator of the actions that change their document
+    '''
+    def changed(chunk):
+        by_index = {}
+        for action in chunk:
+            by_index.setdefault(
+                (action['_index'], action['_type']), []
+            ).append(action)
+        for (index, doc_type), group in by_index.items():
+            response = es.mget(
+                index=index,
+                doc_type=doc_type,
+                body={'ids': [action['_id'] for action in group]},
+                _source=['content_hash']
+            )
+            indexed_hashes = dict(
+                (str(doc['_id']), doc.get('_source', {}).get('content_hash'))
+                for doc in response['docs'] if doc.get('found')
+            )
+            for action in group:
+                content_hash = action['_source'].get('content_hash')
+                if (content_hash is None or
+                        indexed_hashes.get(str(action['_id'])) != content_hash):
+                    yield action
+
+    chunk = []
+    for action in actions:
+        chunk.append(action)
+        if len(chunk) >= chunk_size:
+            for action in changed(chunk):
+                yield action
+            chunk = []
+    if chunk:
+        for action in changed(chunk):
+            yield action
+
+
+# Responses of a busy cluster, retried with exponential backoff.
+# Connection errors and timeouts have no status code.
+RETRY_STATUSES = (429, 503, 'N/A')
+
+
+def bulk_option(value, setting, default):
+    # An option passed explicitly wins over the setting
+    if value is not None:
+        return value
+    return getattr(settings, setting, default)
+
+
+class BulkSender(object):
+    '''
+    Sends bulk actions in requests of at most chunk_size documents and
+    max_chunk_bytes, with up to thread_count requests in flight. Requests
+    and documents rejected by a busy cluster are retried with exponential
+    backoff, so indexing slows down instead of failing. Other failures
+    are collected as bulk error items and recorded as dead letters.
+
+    Settings:
+    ES_BULK_CHUNK_SIZE, ES_BULK_MAX_CHUNK_BYTES, ES_BULK_THREADS,
+    ES_BULK_MAX_RETRIES, ES_BULK_INITIAL_BACKOFF, ES_BULK_MAX_BACKOFF
+    '''
+    def __init__(self, es, chunk_size=None, max_chunk_bytes=None,
+                 thread_count=None, max_retries=None, initial_backoff=None,
+                 max_backoff=None):
+        self.es = es
+        self.chunk_size = bulk_option(
+            chunk_size, 'ES_BULK_CHUNK_SIZE', 500)
+        self.max_chunk_bytes = bulk_option(
+            max_chunk_bytes, 'ES_BULK_MAX_CHUNK_BYTES', 10 * 1024 * 1024)
+        self.thread_count = bulk_option(
+            thread_count, 'ES_BULK_THREADS', 2)
+        self.max_retries = bulk_option(
+            max_retries, 'ES_BULK_MAX_RETRIES', 8)
+        self.initial_backoff = bulk_option(
+            initial_backoff, 'ES_BULK_INITIAL_BACKOFF', 1)
+        self.max_backoff = bulk_option(
+            max_backoff, 'ES_BULK_MAX_BACKOFF', 60)
+        self.indexed = 0
+        self.errors = []
+        self.lock = threading.Lock()
+        self.callback_lock = threading.Lock()
+        # Batches of actions whose callback hasn't run, in order
+        self.batches = []
+        self.queue = None
+        self.threads = []
+        if self.thread_count > 1:
+            # The bounded queue makes send wait for the cluster
+            self.queue = Queue(self.thread_count)
+            for _ in range(self.thread_count):
+                thread = threading.Thread(target=self.run,
+                                          name='elasticsearch-bulk-sender')
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def send(self, actions, callback=None):
+        '''
+        Queues a batch of actions
+        :param actions: An iterable of bulk action dicts
+        :param callback: Called with the number of failed documents once
+            every action of this and earlier batches was sent
+        '''
+        batch = {'pending': 1, 'failed': 0, 'callback': callback}
+        with self.lock:
+            self.batches.append(batch)
+        for chunk in self.chunks(actions):
+            with self.lock:
+                batch['pending'] += 1
+            if self.queue is None:
+                self.send_chunk(batch, chunk)
+            else:
+                self.queue.put((batch, chunk))
+        self.done(batch, 0)
+
+    def close(self):
+        '''
+        Waits until everything queued was sent
+        :return: A tuple of the number of documents sent and
+            the list of bulk error items
+        '''
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        return self.indexed, self.errors
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch, chunk = item
+            try:
+                self.send_chunk(batch, chunk)
+            except Exception as e:
+                logger.exception('Error sending bulk request')
+                errors = self.request_errors(chunk, e)
+                with self.lock:
+                    self.errors.extend(errors)
+                dead_letters.record_bulk_errors(errors)
+                self.done(batch, len(chunk))
+
+    def chunks(self, actions):
+        # Serializes every action once, to measure the request size
+        serializer = self.es.transport.serializer
+        chunk = []
+        size = 0
+        for action in actions:
+            meta, data = expand_action(action)
+            lines = [serializer.dumps(meta)]
+            if data is not None:
+                lines.append(serializer.dumps(data))
+            lines_size = sum(len(line.encode('utf-8')) + 1 for line in lines)
+            if chunk and (len(chunk) >= self.chunk_size or
+                          size + lines_size > self.max_chunk_bytes):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append((meta, lines))
+            size += lines_size
+        if chunk:
+            yield chunk
+
+    def backoff(self, attempt):
+        time.sleep(min(self.max_backoff,
+                       self.initial_backoff * 2 ** (attempt - 1)))
+
+    def send_chunk(self, batch, chunk):
+        indexed = 0
+        errors = []
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.backoff(attempt)
+            body = '\n'.join(line for meta, lines in chunk
+                             for line in lines) + '\n'
+            try:
+                response = self.es.bulk(body=body)
+            except TransportError as e:
+                if e.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                    continue
+                errors.extend(self.request_errors(chunk, e))
+                break
+            retry = []
+            for (meta, lines), item in zip(chunk, response['items']):
+                op_type, info = list(item.items())[0]
+                if 200 <= info.get('status', 500) < 300:
+                    indexed += 1
+                elif (info.get('status') in RETRY_STATUSES and
+                        attempt < self.max_retries):
+                    retry.append((meta, lines))
+                else:
+                    errors.append({op_type: info})
+            chunk = retry
+            if not chunk:
+                break
+        with self.lock:
+            self.indexed += indexed
+            self.errors.extend(errors)
+        dead_letters.record_bulk_errors(errors)
+        self.done(batch, len(errors))
+
+    def request_errors(self, chunk, error):
+        # Every document of a failed request failed with it
+        errors = []
+        for meta, lines in chunk:
+            op_type, info = list(meta.items())[0]
+            info = dict(info, status=getattr(error, 'status_code', None),
+                        error=str(error))
+            errors.append({op_type: info})
+        return errors
+
+    def done(self, batch, failed):
+        # Callbacks of finished batches run one thread at a time, in the
+        # order of the batches, but without blocking the other senders
+        with self.callback_lock:
+            callbacks = []
+            with self.lock:
+                batch['pending'] -= 1
+                batch['failed'] += failed
+                while self.batches and self.batches[0]['pending'] == 0:
+                    finished = self.batches.pop(0)
+                    if finished['callback'] is not None:
+                        callbacks.append(finished)
+            for finished in callbacks:
+                # A failing callback must not count as a failed send,
+                # nor keep the callbacks of later batches from running
+                try:
+                    finished['callback'](finished['failed'])
+                except Exception:
+                    logger.exception('Error running a bulk batch callback')
+
+
+def send_bulk(es, actions, **options):
+    '''
+    Sends bulk actions with a BulkSender
+    :param es: The elasticsearch client
+    :param actions: An iterable of bulk action dicts
+    :param options: The options of BulkSender
+    :return: A tuple of the number of documents sent and
+        the list of bulk error items
+    '''
+    sender = BulkSender(es, **options)
+    try:
+        sender.send(actions)
+    finally:
+        indexed, errors = sender.close()
+    return indexed, errors
+
+
+def scan_index_ids(es, index, size=1000):
+    '''
+    Streams the ids of every document in an index with scroll,
+    in ascending order.
+    :param es: The elasticsearch client
+    :param index: The string name of the index in elasticsearch
+    :param size: The number of ids fetched per scroll request
+    :return: A generator of integer ids
+    '''
+    hits = scan(
+        es,
+        index=index,
+        query={'sort': ['id'], '_source': False},
+        preserve_order=True,
+        size=size
+    )
+    for hit in hits:
+        yield int(hit['_id'])
+
+
+def scan_index_hashes(es, index, size=1000):
+    '''
+    Streams the ids and content hashes of every document in an index
+    with scroll, in ascending order of id.
+    :param es: The elasticsearch client
+    :param index: The string name of the index in elasticsearch
+    :param size: The number of documents fetched per scroll request
+    :return: A generator of (integer id, content hash) pairs
+    '''
+    hits = scan(
+        es,
+        index=index,
+        query={'sort': ['id'], '_source': ['content_hash']},
+        preserve_order=True,
+        size=size
+    )
+    for hit in hits:
+        yield int(hit['_id']), hit.get('_source', {}).get('content_hash')
+
+
+def scan_model_ids(model, chunk_size=10000):
+    '''
+    Streams the primary keys of every object of a model,
+    in ascending order, chunk_size at a time.
+    :param model: The Django/GeoNode model
+    :param chunk_size: The number of primary keys loaded per query
+    :return: A generator of primary keys
+    '''
+    queryset = model.objects.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        chunk_queryset = queryset
+        if last_pk is not None:
+            chunk_queryset = queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk_queryset[:chunk_size])
+        if not chunk:
+            break
+        for pk in chunk:
+            yield pk
+        last_pk = chunk[-1]
+
+
+def sorted_difference(items, others):
+    '''
+    Yields the items missing from others with a merge of two
+    ascending iterables, without loading either in memory.
+    '''
+    others = iter(others)
+    sentinel = object()
+    other = next(others, sentinel)
+    for item in items:
+        while other is not sentinel and other < item:
+            other = next(others, sentinel)
+        if other is sentinel or other != item:
+            yield item
+
+
+def merge_sorted(items, others):
+    '''
+    Joins two iterables of (key, value) pairs in ascending key order
+    with a merge, without loading either in memory.
+    :return: A generator of (key, value, other value) triples, with
+        None for the value missing on either side
+    '''
+    items = iter(items)
+    others = iter(others)
+    sentinel = (None, None)
+    item = next(items, sentinel)
+    other = next(others, sentinel)
+    while item is not sentinel or other is not sentinel:
+        if other is sentinel or (item is not sentinel and item[0] < other[0]):
+            yield item[0], item[1], None
+            item = next(items, sentinel)
+        elif item is sentinel or other[0] < item[0]:
+            yield other[0], None, other[1]
+            other = next(others, sentinel)
+        else:
+            yield item[0], item[1], other[1]
+            item = next(items, sentinel)
+            other = next(others, sentinel)
+
+
+def remove_extraneous_documents(es, model, doctype):
+    '''
+    Removes any documents that exist in a GeoNode index which
+    no longer exist in Django, in one bulk request.
+    :param es: The elasticsearch client
+    :param model: The Django/GeoNode model
+    :param doctype: The doctype corresponding to the index
+    :return: The number of documents removed
+    '''
+    index = doctype._doc_type.index
+    orphans = sorted_difference(scan_index_ids(es, index), scan_model_ids(model))
+    actions = ({
+        '_op_type': 'delete',
+        '_index': index,
+        '_type': doctype._doc_type.name,
+        '_id': orphan
+    } for orphan in orphans)
+    removed, errors = send_bulk(es, actions)
+    return removed
+
+
+def index_service_layers(service, chunk_size=500):
+    '''
+    Re-indexes every layer of a service in bulk, then the profile
+    of each distinct layer owner once.
+    :param service: The GeoNode service
+    :param chunk_size: The number of layers prepared together
+    :return: A dict of indexed and failed layer counts
+    '''
+    es = connections.get_connection()
+    start_time = time.time()
+    layers = service.layer_set.all()
+    total = layers.count()
+    logger.info('Indexing {0} layers of service {1}'.format(total, service))
+
+    def actions():
+        for count, action in enumerate(
+                index_actions(layers, search.LayerIndex, chunk_size), 1):
+            yield action
+            if count % chunk_size == 0:
+                logger.info('Service {0}: built {1}/{2} layers in {3:.1f}s'.format(
+                    service, count, total, time.time() - start_time
+                ))
+
+    try:
+        indexed, errors = send_bulk(es, actions())
+    except Exception as e:
+        # Retried from the database one layer at a time
+        dead_letters.record_many([{
+            'index': search.LayerIndex._doc_type.index,
+            'id': pk,
+            'op_type': 'index',
+            'error': str(e)
+        } for pk in layers.values_list('pk', flat=True)])
+        raise
+    layers_time = time.time() - start_time
+
+    owners = Profile.objects.filter(
+        pk__in=layers.order_by().values('owner_id').distinct()
+    )
+    profiles, profile_errors = send_bulk(
+        es, index_actions(owners, search.ProfileIndex)
+    )
+    for error in errors + profile_errors:
+        logger.error('Error indexing: {}'.format(error))
+    logger.info(
+        'Service {0}: indexed {1} layers ({2} failed) in {3:.1f}s and '
+        '{4} owner profiles ({5} failed) in {6:.1f}s'.format(
+            service, indexed, len(errors), layers_time, profiles,
+            len(profile_errors), time.time() - start_time - layers_time
+        )
+    )
+    return {'indexed': indexed, 'failed': len(errors)}
+
+
+def searchable_indices(es):
+    '''
+    Gets the names of the indices of INDEXED_MODELS that exist, cached
+    for settings.ES_INDEX_LIST_TTL seconds (default 60). The names are
+    the aliases of versioned indices, so other indices in the cluster
+    and previous generations are never searched.
+    :param es: The elasticsearch client
+    :return: A list of index names
+    '''
+    indices = cache.get(SEARCHABLE_INDICES_KEY)
+    if indices is None:
+        indices = [doctype._doc_type.index for model, doctype in INDEXED_MODELS
+                   if es.indices.exists(index=doctype._doc_type.index)]
+        cache.set(SEARCHABLE_INDICES_KEY, indices,
+                  getattr(settings, 'ES_INDEX_LIST_TTL', 60))
+    return list(indices)
+
+
+def invalidate_searchable_indices():
+    # Called when indices are created, swapped or deleted
+    cache.delete(SEARCHABLE_INDICES_KEY)
+
+
+# Rebuilds write into a new generation of each index,
+# named <alias>-<generation>, before swapping the alias
+GENERATION_FORMAT = '%Y%m%d%H%M%S'
+
+
+def generation_index_name(alias, generation):
+    return '{0}-{1}'.format(alias, generation)
+
+
+def is_generation_index(name, alias=None):
+    if alias is None:
+        return re.match(r'^.+-\d{14}$', name) is not None
+    return re.match(r'^{0}-\d{{14}}$'.format(re.escape(alias)), name) is not None
+
+
+def concrete_indices(es, alias):
+    '''
+    Gets the indices behind an alias, or the index itself
+    if it is not an alias.
+    '''
+    if es.indices.exists_alias(name=alias):
+        return sorted(es.indices.get_alias(name=alias).keys())
+    if es.indices.exists(index=alias):
+        return [alias]
+    return []
+
+
+def init_index(es, doctype):
+    '''
+    Creates the index of a doctype, or updates the mapping
+    of the indices behind its alias.
+    '''
+    alias = doctype._doc_type.index
+    for index in concrete_indices(es, alias) or [alias]:
+        doctype.init(index=index)
+    invalidate_searchable_indices()
+
+
+def generation_indices(es, alias):
+    '''
+    Gets the generations of an index, oldest first
+    '''
+    indices = es.indices.get(index='{0}-*'.format(alias))
+    return sorted(i for i in indices if is_generation_index(i, alias))
+
+
+def unfinished_generations(es, alias):
+    '''
+    Gets the generations of an index newer than the one its alias
+    points to, which a running or interrupted rebuild writes to,
+    oldest first
+    '''
+    current = concrete_indices(es, alias)
+    return [i for i in generation_indices(es, alias)
+            if not current or i > max(current)]
+
+
+def generation_actions(es, actions):
+    '''
+    Repeats bulk actions on an alias for the generations a rebuild is
+    filling, so saves and deletes made during rebuild_index aren't lost
+    when the alias is swapped
+    :param es: The elasticsearch client
+    :param actions: An iterable of bulk action dicts
+    :return: A generator of bulk action dicts
+    '''
+    generations = {}
+    for action in actions:
+        yield action
+        alias = action['_index']
+        if alias not in generations:
+            generations[alias] = unfinished_generations(es, alias)
+        for index in generations[alias]:
+            yield dict(action, _index=index)
+
+
+def swap_alias(es, alias, index):
+    '''
+    Atomically points an alias to another index
+    :param es: The elasticsearch client
+    :param alias: The name searched and written to, e.g. layer-index
+    :param index: The index the alias should point to
+    '''
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    if es.indices.exists_alias(name=alias):
+        for old_index in es.indices.get_alias(name=alias):
+            if old_index != index:
+                actions.append(
+                    {'remove': {'index': old_index, 'alias': alias}}
+                )
+    elif es.indices.exists(index=alias):
+        # An index from before versioned rebuilds has the alias's name
+        # and has to be removed in the same step
+        actions.append({'remove_index': {'index': alias}})
+    es.indices.update_aliases(body={'actions': actions})
+    invalidate_searchable_indices()
+
+
+def prune_generations(es, alias, keep=1):
+    '''
+    Deletes old generations of an index, keeping the
+    newest keep generations the alias doesn't point to for rollback.
+    :return: The deleted index names
+    '''
+    current = concrete_indices(es, alias)
+    old = [i for i in generation_indices(es, alias) if i not in current]
+    if keep > 0:
+        old = old[:-keep]
+    for index in old:
+        es.indices.delete(index=index)
+    return old
+
+
+@contextmanager
+def bulk_load(es, indices, force_merge=False):
+    '''
+    Turns off refreshes and replicas of indices while they are filled,
+    then restores their original settings, even if filling them fails.
+    :param es: The elasticsearch client
+    :param indices: The names of the concrete indices
+    :param force_merge: If True, merge each index to one segment
+        once it was filled successfully
+    '''
+    original = {}
+    for index, info in es.indices.get_settings(
+            index=','.join(indices), flat_settings=True).items():
+        index_settings = info['settings']
+        # A missing refresh_interval is restored to the default with None
+        original[index] = {
+            'index.refresh_interval': index_settings.get('index.refresh_interval'),
+            'index.number_of_replicas': index_settings.get('index.number_of_replicas')
+        }
+    for index in original:
+        es.indices.put_settings(index=index, body={
+            'index.refresh_interval': '-1',
+            'index.number_of_replicas': 0
+        })
+
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        for index, index_settings in original.items():
+            es.indices.put_settings(index=index, body=index_settings)
+        es.indices.refresh(index=','.join(original))
+        if succeeded and force_merge:
+            es.indices.forcemerge(index=','.join(original), max_num_segments=1)
@@ -3,14 +3,20 @@ import re
 
 from django.conf import settings
 from django.http import JsonResponse, HttpResponse
-from elasticsearch import Elasticsearch
+from elasticsearch import ConnectionError
 import elasticsearch_dsl
-from guardian.shortcuts import get_objects_for_user
+from elasticsearch_dsl.utils import AttrDict
 from six import iteritems
 from django.contrib import messages
+from django.contrib.auth.models import Group
+from guardian.utils import get_anonymous_user
 import json
 
 from geonode.base.models import TopicCategory
+from elasticsearch_app.client import get_client, health
+from elasticsearch_app.permissions import visible_resource_ids
+from elasticsearch_app.search import PermissionIndex, permission_document_id
+from elasticsearch_app.utils import searchable_indices
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -34,6 +40,9 @@ def edsl_base_init(self, _expand__to_dot=False, **params):
 elasticsearch_dsl.utils.DslBase.__init__ = edsl_base_init
 Q = elasticsearch_dsl.query.Q
 
+# Name of the aggregation of the facets not filtered by the search
+OVERALL_AGGREGATION = 'overall'
+
 
 def get_unified_search_result_objects(hits):
     # Reformat objects for use in the results.
@@ -124,23 +133,63 @@ def get_base_query(search):
 def apply_base_filter(request, search):
     '''
     Filter results based on which objects geonode allows access to.
+    settings.ES_PERMISSION_FILTER chooses how:
+    'acl' (default) matches the users and groups indexed with each
+    resource, 'ids' sends the cached ids of the resources the user
+    can view and 'lookup' looks the uuids of the resources up in the
+    permission documents of the user and their groups.
     '''
     if settings.SKIP_PERMS_FILTER is False:
         # Various resources do not have is_published,
         # which end up affecting results
         # if settings.RESOURCE_PUBLISHING:
-        if not request.user.is_superuser:
+        user = request.user
+        if not user.is_superuser and not user.has_perm('base.view_resourcebase'):
             logger.info('Filtering resources from search based on permissions')
-            # Get the list of objects the user has access to
-            filter_set = get_objects_for_user(
-                request.user,
-                'base.view_resourcebase'
-            )
-
-            resource_uuids = map(str, filter_set.values_list('uuid', flat=True))
-            username = request.user.get_username()
-            logger.debug("Resource UUIDs: {}. Username: {}".format(resource_uuids, username))
-            search = search.filter(Q('terms', uuid=resource_uuids) | Q(
+            permission_filter = getattr(settings, 'ES_PERMISSION_FILTER', 'acl')
+            if permission_filter == 'ids':
+                # Get the list of objects the user has access to,
+                # cached until permissions or resources change
+                resource_ids = visible_resource_ids(user)
+                logger.debug("Resource IDs: {}. Username: {}".format(
+                    len(resource_ids), user.get_username()))
+                resource_filter = Q('terms', id=list(resource_ids))
+            elif permission_filter == 'lookup':
+                # Elasticsearch reads the uuids from the permission
+                # documents of the user and their groups and caches them
+                if user.pk is not None:
+                    principals = [permission_document_id('user', user.pk)]
+                    principals.extend(
+                        permission_document_id('group', group_id)
+                        for group_id in user.groups.values_list('id', flat=True)
+                    )
+                else:
+                    # What the anonymous user and group can view
+                    principals = [
+                        permission_document_id('user', get_anonymous_user().pk)
+                    ]
+                    principals.extend(
+                        permission_document_id('group', group_id)
+                        for group_id in Group.objects.filter(
+                            name='anonymous').values_list('id', flat=True)
+                    )
+                resource_filter = Q('bool', should=[
+                    Q('terms', uuid={
+                        'index': PermissionIndex._doc_type.index,
+                        'type': PermissionIndex._doc_type.name,
+                        'id': principal,
+                        'path': 'resources'
+                    }) for principal in principals
+                ])
+            else:
+                resource_filter = Q('term', public=True)
+                if user.pk is not None:
+                    group_ids = user.groups.values_list('id', flat=True)
+                    resource_filter |= Q('term', read_users=str(user.pk))
+                    resource_filter |= Q('terms', read_groups=[
+                        str(group_id) for group_id in group_ids
+                    ])
+            search = search.filter(resource_filter | Q(
                 {"match": {"type": "group"}}) | Q(
                 {"match": {"type": "user"}})
             )
@@ -512,50 +561,88 @@ def filter_results_by_facets(aggregations, facet_results):
     return facet_results
 
 
+def split_aggregations(aggregations):
+    '''
+    Splits the aggregations of a search into the overall facets and
+    the facets of the results, in the shape of separate searches
+    '''
+    aggregations = aggregations.to_dict()
+    # A search of only missing indices returns no aggregations
+    overall = aggregations.pop(OVERALL_AGGREGATION, {}).get('filtered', {})
+    overall.pop('doc_count', None)
+    return AttrDict(overall), AttrDict(aggregations)
+
+
+def connection_error_response(request):
+    error_msg = 'Could not connect to Elasticsearch. Either Elasticsearch'\
+                + ' is down or ES_URL is not configured correctly'
+    messages.warning(request, error_msg)
+    logger.warn(error_msg)
+    logger.warn('ES_URL: {}'.format(settings.ES_URL))
+    # Serialize the messages for the front end
+    django_messages = []
+    for message in messages.get_messages(request):
+        django_messages.append({
+            "message": message.message,
+            "tags": message.tags
+        })
+    return JsonResponse({"messages": django_messages})
+
+
 def elastic_search(request, resourcetype='base'):
+    # Fail fast while recent requests couldn't connect,
+    # instead of pinging before every search
+    if not health.available():
+        return connection_error_response(request)
+    try:
+        return run_search(request, resourcetype)
+    except ConnectionError:
+        return connection_error_response(request)
+
+
+def run_search(request, resourcetype):
     parameters = request.GET
-    es = Elasticsearch(settings.ES_URL)
-
-    if es.ping() is False:
-        error_msg = 'Could not connect to Elasticsearch. Either Elasticsearch'\
-                    + ' is down or ES_URL is not configured correctly'
-        messages.warning(request, error_msg)
-        logger.warn(error_msg)
-        logger.warn('ES_URL: {}'.format(settings.ES_URL))
-        # Serialize the messages for the front end
-        django_messages = []
-        for message in messages.get_messages(request):
-            django_messages.append({
-                "message": message.message,
-                "tags": message.tags
-            })
-        return JsonResponse({"messages": django_messages})
+    es = get_client()
 
     # exclude the profile and group indexes.
     # They aren't being used, and cause issues with faceting
-    indices = es.indices.get_alias("*").keys()
+    indices = searchable_indices(es)
     exclude_indexes = []
     [indices.remove(i) for i in exclude_indexes if i in indices]
 
-    search = elasticsearch_dsl.Search(using=es, index=indices)
+    if not indices:
+        # An empty list would search every index in the cluster
+        return JsonResponse({
+            "meta": {"limit": 0, "next": None, "offset": 0, "previous": None,
+                     "total_count": 0, "facets": {}},
+            "objects": []
+        })
+
+    # An index deleted since the list was cached is skipped
+    search = elasticsearch_dsl.Search(using=es, index=indices).params(
+        ignore_unavailable=True
+    )
     # search = get_base_query(search)
     search = apply_base_filter(request, search)
 
-    # Add facets to search
+    # Add facets to search.
+    # The overall facets are only filtered by what a particular user is
+    # able to see, this makes sure to get every item that is possible in
+    # the facets in order for a UI to build the choices. A global
+    # aggregation ignores the main query, so they come with the results.
+    base_query = Q(search.to_dict().get('query', {'match_all': {}}))
+    overall = search.aggs.bucket(OVERALL_AGGREGATION, 'global').bucket(
+        'filtered', 'filter', base_query
+    )
     for fn in get_facet_fields():
-        search.aggs.bucket(
-            fn,
-            'terms',
-            field=fn,
-            order={"_count": "desc"},
-            size=parameters.get("nfacets", 15)
-        )
-
-    # run search only filtered by what a particular user is able to see
-    # this makes sure to get every item that is possible in the facets
-    # in order for a UI to build the choices
-    overall_results = search[0:0].execute()
-    facet_results = get_facet_results(overall_results.aggregations, parameters)
+        for aggs in (overall, search.aggs):
+            aggs.bucket(
+                fn,
+                'terms',
+                field=fn,
+                order={"_count": "desc"},
+                size=parameters.get("nfacets", 15)
+            )
 
     search = filter_by_resource_type(search, resourcetype)
     search = get_main_query(search, parameters.get('q', None))
@@ -581,8 +668,12 @@ def elastic_search(request, resourcetype='base'):
 
     logger.debug('search: {}, results: {}'.format(search, results))
 
+    overall_aggregations, aggregations = split_aggregations(
+        results.aggregations
+    )
+    facet_results = get_facet_results(overall_aggregations, parameters)
     filtered_facet_results = filter_results_by_facets(
-        results.aggregations,
+        aggregations,
         facet_results
     )
     # Get results
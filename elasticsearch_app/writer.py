@@ -0,0 +1,288 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections, transaction
+from elasticsearch_dsl import connections as es_connections
+from six.moves.queue import Queue, Empty, Full
+
+from elasticsearch_app import dead_letters
+from elasticsearch_app.utils import (
+    generation_actions,
+    index_actions,
+    index_object,
+    send_bulk
+)
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+INDEX = 'index'
+DELETE = 'delete'
+CALL = 'call'
+
+
+class IndexWriter(object):
+    '''
+    Indexes objects from a bounded queue in a background thread.
+    Repeated updates of the same document within flush_interval seconds
+    are merged and everything pending is sent in one bulk request.
+    Documents that can't be built or sent are recorded as dead letters.
+    Everything is also sent to a generation rebuild_index is filling.
+    '''
+    def __init__(self, maxsize=1000, flush_interval=0.5):
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.stopping = False
+
+    def start(self):
+        with self.lock:
+            # A forked process inherits the queue but not the thread
+            if self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.queue = Queue(self.maxsize)
+            self.thread = threading.Thread(
+                target=self.run,
+                name='elasticsearch-index-writer'
+            )
+            self.thread.daemon = True
+            self.thread.start()
+
+    def put(self, op, model, pk, doctype):
+        '''
+        Queues an index or delete of a document
+        :return: False if the queue is full or the writer is stopping
+        '''
+        if self.stopping:
+            return False
+        self.start()
+        try:
+            self.queue.put_nowait((op, model, pk, doctype))
+            return True
+        except Full:
+            return False
+
+    def call(self, key, func, *args):
+        '''
+        Queues a function to run in the writer thread. Calls queued
+        with the same key within flush_interval only run once.
+        :return: False if the queue is full
+        '''
+        return self.put(CALL, func, args, key)
+
+    def stop(self):
+        '''
+        Flushes everything queued and stops the thread, waiting for it
+        however long it takes. Whatever is queued afterwards is indexed
+        right away by the caller.
+        '''
+        self.stopping = True
+        if self.pid != os.getpid() or not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            pending = OrderedDict()
+            self.merge(pending, item)
+            deadline = time.time() + self.flush_interval
+            stopping = False
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                self.merge(pending, item)
+            self.flush(pending)
+            if stopping:
+                return
+
+    def merge(self, pending, item):
+        # The last operation on a document wins
+        op, model, pk, doctype = item
+        if op == CALL:
+            key = (CALL, doctype)
+        else:
+            key = (doctype._doc_type.index, pk)
+        pending.pop(key, None)
+        pending[key] = item
+
+    def flush(self, pending):
+        actions = []
+        to_index = OrderedDict()
+        calls = []
+        for op, model, pk, doctype in pending.values():
+            if op == CALL:
+                calls.append((model, pk))
+            elif op == DELETE:
+                actions.append({
+                    '_op_type': 'delete',
+                    '_index': doctype._doc_type.index,
+                    '_type': doctype._doc_type.name,
+                    '_id': pk
+                })
+            else:
+                to_index.setdefault((model, doctype), []).append(pk)
+        # Objects are loaded when flushed, so the latest saved
+        # state is indexed, prepared together per model
+        for (model, doctype), pks in to_index.items():
+            actions.extend(self.build(model, doctype, pks))
+        try:
+            # This already runs in the background. Failed documents
+            # are recorded as dead letters by the bulk sender.
+            es = es_connections.get_connection()
+            indexed, errors = send_bulk(es, generation_actions(es, actions),
+                                        thread_count=1)
+            for error in errors:
+                # Deleting a document that was never indexed is fine
+                if error.get('delete', {}).get('status') != 404:
+                    logger.error('Error indexing: {}'.format(error))
+        except Exception as e:
+            logger.exception('Error flushing the index queue')
+            record_dropped([(action['_index'], action['_id'],
+                             action.get('_op_type', 'index'))
+                            for action in actions], e)
+        for func, args in calls:
+            # The queued functions record their own failed documents
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Error running queued indexing')
+        # Connections opened by this thread are not closed by Django
+        connections.close_all()
+
+    def build(self, model, doctype, pks):
+        '''
+        Builds the bulk actions of the objects of a model together,
+        or one at a time if that fails, so one bad row only drops itself
+        :return: A list of bulk action dicts
+        '''
+        try:
+            return list(index_actions(model.objects.filter(pk__in=pks),
+                                      doctype))
+        except Exception:
+            logger.exception('Error building {0} documents'.format(
+                doctype._doc_type.index
+            ))
+        actions = []
+        for pk in pks:
+            try:
+                actions.extend(index_actions(model.objects.filter(pk=pk),
+                                             doctype))
+            except Exception as e:
+                record_dropped([(doctype._doc_type.index, pk, 'index')], e)
+        return actions
+
+
+def record_dropped(documents, error):
+    '''
+    Records documents the writer couldn't index as dead letters
+    :param documents: A list of (index, id, op_type) triples
+    :param error: The exception that dropped them
+    '''
+    dead_letters.record_many([{
+        'index': index,
+        'id': id,
+        'op_type': op_type,
+        'error': str(error)
+    } for index, id, op_type in documents])
+
+
+writer = IndexWriter(
+    maxsize=getattr(settings, 'ES_INDEX_QUEUE_SIZE', 1000),
+    flush_interval=getattr(settings, 'ES_INDEX_FLUSH_INTERVAL', 0.5)
+)
+atexit.register(writer.stop)
+
+
+def index_now(actions):
+    # Saves index synchronously when the writer can't take them
+    es = es_connections.get_connection()
+    indexed, errors = send_bulk(es, generation_actions(es, actions),
+                                thread_count=1)
+    for error in errors:
+        if error.get('delete', {}).get('status') != 404:
+            logger.error('Error indexing: {}'.format(error))
+
+
+def on_commit(func):
+    # Only index once the saved data is visible to other connections
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(func)
+    else:
+        func()
+
+
+def queue_index(instance, doctype):
+    '''
+    Indexes an object in the background, or right away if
+    settings.ES_ASYNC_INDEXING is False or the queue is full.
+    :param instance: The object to index
+    :param doctype: The doctype corresponding to the index
+    '''
+    if instance is None:
+        return
+    model, pk = instance.__class__, instance.pk
+
+    def put():
+        if getattr(settings, 'ES_ASYNC_INDEXING', True):
+            if writer.put(INDEX, model, pk, doctype):
+                return
+        index_now([index_object(instance, doctype, save=False)])
+    on_commit(put)
+
+
+def queue_call(key, func, *args):
+    '''
+    Runs an indexing function in the background, or right away if
+    settings.ES_ASYNC_INDEXING is False or the queue is full.
+    :param key: Calls with the same key queued together only run once
+    :param func: The function to run
+    '''
+    def put():
+        if getattr(settings, 'ES_ASYNC_INDEXING', True):
+            if writer.call(key, func, *args):
+                return
+        func(*args)
+    on_commit(put)
+
+
+def queue_delete(instance, doctype):
+    '''
+    Removes an object's document in the background, or right away if
+    settings.ES_ASYNC_INDEXING is False or the queue is full.
+    :param instance: The deleted object
+    :param doctype: The doctype corresponding to the index
+    '''
+    pk = instance.pk
+
+    def put():
+        if getattr(settings, 'ES_ASYNC_INDEXING', True):
+            if writer.put(DELETE, None, pk, doctype):
+                return
+        index_now([{
+            '_op_type': 'delete',
+            '_index': doctype._doc_type.index,
+            '_type': doctype._doc_type.name,
+            '_id': pk
+        }])
+    on_commit(put)